@@ -1,6 +1,9 @@
 import warnings
 import json
 import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
@@ -8,7 +11,127 @@ import numpy as np
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 
+# cache of the national p-value table built by load_pvalue_df
+PVALUE_CACHE = os.path.join("output", "cache", "pvalue_df.parquet")
+
+# cache folder of the simulated instance tables built by read_simulated_instances
+SIMULATIONS_CACHE = os.path.join("output", "cache")
+# folder of a simulated configuration, e.g. I100_B50_G2_C3_lambda50
+SIMULATION_FOLDER = re.compile(r"I(\d+)_B(\d+)_G(\d+)_C(\d+)_lambda(\d+)")
+# result file of a seed, e.g. 12.json (runs like 1_pinit3.json are not seeds)
+SIMULATION_SEED_FILE = re.compile(r"(\d+)\.json")
+SIMULATION_COLUMNS = ['I', 'B', 'G', 'C', 'lambda', 'method', 'seed',
+                      'time', 'simulate_time', 'iterations', 'status',
+                      'mean_error', 'max_error']
+
+
+# finds the result files of simulated_instances: [(I, B, G, C, lambda code, method, seed, path)]
+def discover_simulated_instances(output_dir):
+    runs = []
+    for folder in sorted(os.scandir(output_dir), key=lambda e: e.name):
+        config = SIMULATION_FOLDER.fullmatch(folder.name)
+        if config is None or not folder.is_dir():
+            continue
+        for method in sorted(os.scandir(folder.path), key=lambda e: e.name):
+            if not method.is_dir():
+                continue
+            for file in os.scandir(method.path):
+                seed = SIMULATION_SEED_FILE.fullmatch(file.name)
+                if seed is not None:
+                    runs.append((*map(int, config.groups()), method.name, int(seed.group(1)), file.path))
+    return runs
+
+
+# reads the fields of a simulated instance used in the table, None if the file can't be read
+def read_simulated_instance(path):
+    try:
+        with open(path, 'r') as f:
+            data = load_json_keys(f.read(), ['real_prob', 'prob', 'time', 'iterations', 'status'])
+        return (np.array(data['real_prob'], dtype=float), np.array(data['prob'], dtype=float),
+                data['time'], data['iterations'], data['status'])
+    except Exception as e:
+        # uncomment for debugging
+        # print(f"[!] Error reading {path}: {e}")
+        return None
+
+
+# builds the table of all simulated instances found in output_dir
+def build_simulated_instances(output_dir, runs, jobs=None):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        data = list(executor.map(read_simulated_instance, [run[-1] for run in runs]))
+
+    rows = [(run, d) for run, d in zip(runs, data)
+            if d is not None and d[0].ndim == 2 and d[0].shape == d[1].shape]
+    df = pd.DataFrame([run[:-1] for run, _ in rows], columns=['I', 'B', 'G', 'C', 'lambda', 'method', 'seed'])
+    df['lambda'] = df['lambda'] / 100
+    df['time'] = np.array([d[2] for _, d in rows], dtype=float)
+    df['simulate_time'] = np.where(df['method'].str.contains('simulate'), 0, np.nan)
+    df['iterations'] = np.array([d[3] for _, d in rows], dtype=np.int64)
+    df['status'] = np.array([d[4] for _, d in rows], dtype=np.int64)
+
+    # errors are computed at once for all instances with the same (G, C)
+    df['mean_error'] = np.nan
+    df['max_error'] = np.nan
+    shapes = np.array([d[0].shape for _, d in rows]).reshape(-1, 2)
+    for shape in np.unique(shapes, axis=0):
+        index = np.flatnonzero((shapes == shape).all(axis=1))
+        errors = np.abs(np.stack([rows[i][1][0] for i in index]) - np.stack([rows[i][1][1] for i in index]))
+        df.loc[index, 'mean_error'] = errors.mean(axis=(1, 2))
+        df.loc[index, 'max_error'] = errors.max(axis=(1, 2))
+    return df[SIMULATION_COLUMNS]
+
+
+# table of all simulated instances of output_dir, cached in SIMULATIONS_CACHE
+def load_simulated_instances(output_dir, jobs=None, use_cache=True):
+    runs = discover_simulated_instances(output_dir)
+    signature = files_signature([run[-1] for run in runs], root=output_dir)
+    name = os.path.basename(os.path.normpath(output_dir))
+    cache_file = os.path.join(SIMULATIONS_CACHE, f"{name}.parquet")
+    signature_file = os.path.join(SIMULATIONS_CACHE, f"{name}.json")
+
+    df = None
+    if use_cache and os.path.exists(cache_file) and os.path.exists(signature_file):
+        with open(signature_file, 'r') as f:
+            if json.load(f) == signature:
+                df = pd.read_parquet(cache_file)
+    if df is None:
+        df = build_simulated_instances(output_dir, runs, jobs=jobs)
+        if use_cache:
+            os.makedirs(SIMULATIONS_CACHE, exist_ok=True)
+            df.to_parquet(cache_file)
+            with open(signature_file, 'w') as f:
+                json.dump(signature, f)
+    return df
+
+
+# table of the simulated instances kept by the filters, answered from the SQLite catalog
+def query_simulated_instances(catalog, output_dir, I_list, B_list, G_list, C_list, lambda_list, seed_list, methods):
+    # imported here as the catalog module imports aux_functions
+    from catalog import connect, refresh_simulations
+
+    conn = connect(catalog)
+    refresh_simulations(conn, output_dir)
+    query = ("SELECT I, B, G, C, lambda, method, seed, time, iterations, status, mean_error, max_error "
+             "FROM simulations WHERE root = ? AND seed IS NOT NULL AND status IS NOT NULL "
+             "AND time IS NOT NULL AND iterations IS NOT NULL AND mean_error IS NOT NULL")
+    params = [os.path.normpath(output_dir)]
+    lambdas = None if lambda_list is None else [int(100 * l) / 100 for l in lambda_list]
+    for column, allowed in zip(['I', 'B', 'G', 'C', 'lambda', 'method', 'seed'],
+                               [I_list, B_list, G_list, C_list, lambdas, methods, seed_list]):
+        if allowed is not None:
+            query += f" AND {column} IN ({', '.join('?' * len(allowed))})"
+            params += list(allowed)
+    df = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+    df['simulate_time'] = np.where(df['method'].str.contains('simulate'), 0, np.nan)
+    return df[SIMULATION_COLUMNS]
+
+
 # function to read simulated_instances into a dataframe
+# runs are found from the directory tree and read in parallel by `jobs` threads; the table of all
+# runs is cached in SIMULATIONS_CACHE and reused while no result file changes (mtime and size)
+# with catalog (path of a SQLite catalog, see catalog.py) the rows are queried from the catalog
+# the filters keep the rows of the given values, None keeps all the values found
 def read_simulated_instances(
     output_dir='output/simulated_instances',
     I_list=[100],
@@ -17,62 +140,279 @@ def read_simulated_instances(
     C_list=[2, 3, 4, 5, 10],
     lambda_list=[0.5],
     seed_list=list(range(1, 21)),
-    methods=['exact', 'mcmc_100', 'mcmc_1000', 'mvn_cdf', 'mvn_pdf', 'mult']
+    methods=['exact', 'mcmc_100', 'mcmc_1000', 'mvn_cdf', 'mvn_pdf', 'mult'],
+    jobs=None,
+    use_cache=True,
+    catalog=None
 ):
-    df_rows = []
-
-    for I in I_list:
-        for B in B_list:
-            for G in G_list:
-                for C in C_list:
-                    for lambda_ in lambda_list:
-                        for method in methods:
-                            for seed in seed_list:
-                                path = os.path.join(
-                                    output_dir,
-                                    f'I{I}_B{B}_G{G}_C{C}_lambda{int(100 * lambda_)}',
-                                    method,
-                                    f'{seed}.json'
-                                )
-                                try:
-                                    with open(path, 'r') as f:
-                                        data = json.load(f)
-
-                                    p_real = np.array(data['real_prob'])
-                                    p_est = np.array(data['prob'])
-
-                                    mean_error = np.mean(np.abs(p_real - p_est))
-                                    max_error = np.max(np.abs(p_real - p_est))
-                                    time = data['time']
-                                    simulate_time = 0 if 'simulate' in method else np.nan
-                                    iterations = data['iterations']
-                                    status = data['status']
-
-                                    df_rows.append([
-                                        I, B, G, C, lambda_, method, seed,
-                                        time, simulate_time, iterations, status,
-                                        mean_error, max_error
-                                    ])
-                                except Exception as e:
-                                    # uncomment for debugging
-                                    # print(f"[!] Error reading {path}: {e}")
-                                    continue
-
-    columns = ['I', 'B', 'G', 'C', 'lambda', 'method', 'seed',
-               'time', 'simulate_time', 'iterations', 'status',
-               'mean_error', 'max_error']
-    
-    return pd.DataFrame(df_rows, columns=columns)
+    if catalog is not None:
+        df = query_simulated_instances(catalog, output_dir, I_list, B_list, G_list, C_list,
+                                       lambda_list, seed_list, methods)
+    else:
+        df = load_simulated_instances(output_dir, jobs=jobs, use_cache=use_cache)
+
+    # keep the requested runs, in the order of the lists
+    order = []
+    keep = np.ones(len(df), dtype=bool)
+    values = {'I': I_list, 'B': B_list, 'G': G_list, 'C': C_list,
+              'lambda': None if lambda_list is None else [int(100 * l) / 100 for l in lambda_list],
+              'method': methods, 'seed': seed_list}
+    for column, allowed in values.items():
+        if allowed is None:
+            order.append(df[column])
+            continue
+        position = df[column].map({value: i for i, value in enumerate(allowed)})
+        keep &= position.notna().to_numpy()
+        order.append(position)
+    df = df[keep]
+    order = pd.DataFrame({i: o[keep] for i, o in enumerate(order)})
+    return df.loc[order.sort_values(list(order.columns), kind='stable').index].reset_index(drop=True)
+
+
+# pairwise distances between the estimated probability matrices of different initializations
+# probs has shape (S, G, C); returns the distances of all pairs i < j, in the order of np.triu_indices
+def pairwise_distances(probs, metric='mae'):
+    diff = np.abs(probs[:, None] - probs[None, :])
+    if metric == 'mae':
+        distances = diff.mean(axis=(2, 3))
+    elif metric == 'max':
+        distances = diff.max(axis=(2, 3))
+    elif metric == 'frobenius':
+        distances = np.sqrt((diff ** 2).sum(axis=(2, 3)))
+    else:
+        raise ValueError(f"Unknown metric '{metric}', use 'mae', 'max' or 'frobenius'.")
+    i, j = np.triu_indices(len(probs), k=1)
+    return i, j, distances[i, j]
+
+
+# distances between all pairs of initializations (1_pinit{seed}.json) of a configuration
+def config_init_sensitivity(results_folder, I, B, G, C, lambda_, seed_list, method, metric):
+    folder = os.path.join(results_folder, f'I{I}_B{B}_G{G}_C{C}_lambda{int(100 * lambda_)}', method)
+    seeds, probs = [], []
+    for seed in seed_list:
+        file_path = os.path.join(folder, f'1_pinit{seed}.json')
+        if not os.path.exists(file_path):
+            print("File not found:", file_path)
+            continue
+        with open(file_path, 'r') as f:
+            probs.append(np.array(load_json_keys(f.read(), ['prob'])['prob'], dtype=float))
+        seeds.append(seed)
+    if len(seeds) < 2:
+        return np.array(seeds)[[]], np.array(seeds)[[]], np.array([])
+    i, j, distances = pairwise_distances(np.stack(probs), metric)
+    return np.array(seeds)[i], np.array(seeds)[j], distances
+
+
+def init_sensitivity(
+    results_folder='output/simulated_instances',
+    I_list=[100],
+    B_list=[50],
+    G_list=[2, 3, 4],
+    C_list=[2, 3, 4],
+    lambda_list=[0.5],
+    cv_list=[1000],
+    seed_list=list(range(1, 21)),
+    method='exact',
+    metric='mae',
+    jobs=None
+):
+    """
+    Compare the estimates of an EM method run from different random initial probabilities.
+
+    Each initialization (1_pinit{seed}.json) is read once and the distances between all
+    pairs of seeds are computed at once; configurations are processed by `jobs` threads.
+    Missing initializations are reported and left out of the pairs.
 
+    Parameters:
+        metric (str): 'mae' (mean absolute difference), 'max' (maximum absolute
+            difference) or 'frobenius' (Frobenius norm of the difference).
 
-def read_district(district_name, last_name="", folder=""):
+    Returns:
+        pd.DataFrame: One row per configuration, cv and pair seed1 < seed2, with the
+            distance in 'dif_instance'.
+    """
+    configs = [(I, B, G, C, lambda_) for I in I_list for B in B_list for G in G_list
+               for C in C_list for lambda_ in lambda_list]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(
+            lambda config: config_init_sensitivity(results_folder, *config, seed_list, method, metric), configs))
+
+    frames = []
+    for (I, B, G, C, lambda_), (seed1, seed2, distances) in zip(configs, results):
+        for cv in cv_list:
+            frames.append(pd.DataFrame({'I': I, 'M': B, 'G': G, 'C': C, 'lambda': lambda_, 'cv': cv,
+                                        'seed1': seed1, 'seed2': seed2, 'dif_instance': distances}))
+    columns = ['I', 'M', 'G', 'C', 'lambda', 'cv', 'seed1', 'seed2', 'dif_instance']
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+# patterns used to skip JSON values without building Python objects for them
+JSON_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+JSON_SCALAR = re.compile(r'[^,}\]\s]+')
+JSON_CONTAINER_TOKEN = re.compile(r'[\[\]{}"]')
+JSON_WHITESPACE = re.compile(r'\s*')
+
+
+# returns the position right after the JSON value that starts at pos
+def skip_json_value(text, pos):
+    char = text[pos]
+    if char == '"':
+        return JSON_STRING.match(text, pos).end()
+    if char not in "[{":
+        return JSON_SCALAR.match(text, pos).end()
+    # fast path for containers without strings (numeric arrays): the value ends at the
+    # last bracket before the next quote if the brackets in between are balanced
+    quote = text.find('"', pos)
+    if quote != -1:
+        end = max(text.rfind("]", pos, quote), text.rfind("}", pos, quote)) + 1
+        opened = text.count("[", pos, end) + text.count("{", pos, end)
+        if end > pos and opened == text.count("]", pos, end) + text.count("}", pos, end):
+            return end
+    depth = 0
+    while True:
+        token = JSON_CONTAINER_TOKEN.search(text, pos)
+        if token is None:
+            raise json.JSONDecodeError("Unterminated container", text, pos)
+        if token.group() == '"':
+            pos = JSON_STRING.match(text, token.start()).end()
+            continue
+        pos = token.end()
+        depth += 1 if token.group() in "[{" else -1
+        if depth == 0:
+            return pos
+
+
+# parses only the wanted top-level keys of a JSON object, skipping the other values
+def load_json_keys(text, keys):
+    keys = set(keys)
+    decoder = json.JSONDecoder()
+    result = {}
+    pos = JSON_WHITESPACE.match(text, 0).end()
+    if text[pos] != "{":
+        raise json.JSONDecodeError("Expecting a JSON object", text, pos)
+    pos += 1
+    while len(result) < len(keys):
+        pos = JSON_WHITESPACE.match(text, pos).end()
+        if text[pos] == "}":
+            break
+        key, pos = decoder.raw_decode(text, pos)
+        pos = JSON_WHITESPACE.match(text, pos).end() + 1  # skip the colon
+        pos = JSON_WHITESPACE.match(text, pos).end()
+        if key in keys:
+            result[key], pos = decoder.raw_decode(text, pos)
+        else:
+            pos = skip_json_value(text, pos)
+        pos = JSON_WHITESPACE.match(text, pos).end()
+        if text[pos] == ",":
+            pos += 1
+    return result
+
+
+# process-wide LRU cache shared by read_district and get_district_arrays
+# there is one entry per (kind, file), stored with the mtime and size of the file it was read from
+# and the fields read so far (None once the whole file is read), so a subset of fields already
+# read is served from the entry and newly read fields are merged into it; entries are evicted
+# least recently used first once their estimated size exceeds the budget
+DISTRICT_CACHE = OrderedDict()
+DISTRICT_CACHE_INFO = {"hits": 0, "misses": 0, "bytes": 0, "max_bytes": 2**30}
+
+
+# approximate memory used by a parsed JSON value or a dictionary of arrays
+def cache_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(cache_nbytes(v) for v in value.values())
+    if isinstance(value, list):
+        if value and isinstance(value[0], (list, dict)):
+            return 8 * len(value) + sum(cache_nbytes(v) for v in value)
+        return 40 * len(value)  # pointer plus number object
+    if isinstance(value, str):
+        return 49 + len(value)
+    return 32
+
+
+# returns the cached fields of key (all of them if fields is None) if the file did not change
+# since they were cached and all of them were read; fields missing in the file are left out
+def district_cache_get(key, signature, fields=None):
+    entry = DISTRICT_CACHE.get(key)
+    if entry is None or entry[0] != signature:
+        entry = None
+    elif entry[3] is not None and (fields is None or not set(fields) <= entry[3]):
+        entry = None  # only some of the fields were read
+    if entry is None:
+        DISTRICT_CACHE_INFO["misses"] += 1
+        return None
+    DISTRICT_CACHE.move_to_end(key)
+    DISTRICT_CACHE_INFO["hits"] += 1
+    value = entry[1]
+    return dict(value) if fields is None else {field: value[field] for field in fields if field in value}
+
+
+# caches the fields read from a file (all of them if fields is None), merged with the fields
+# already cached for the same version of the file
+def district_cache_put(key, signature, value, fields=None):
+    entry = DISTRICT_CACHE.get(key)
+    if fields is not None:
+        fields = set(fields)
+        if entry is not None and entry[0] == signature:
+            value = {**entry[1], **value}
+            fields = None if entry[3] is None else entry[3] | fields
+    district_cache_pop(key)
+    nbytes = cache_nbytes(value)
+    if nbytes > DISTRICT_CACHE_INFO["max_bytes"]:
+        return
+    DISTRICT_CACHE[key] = (signature, value, nbytes, fields)
+    DISTRICT_CACHE_INFO["bytes"] += nbytes
+    district_cache_evict()
+
+
+def district_cache_pop(key):
+    entry = DISTRICT_CACHE.pop(key, None)
+    if entry is not None:
+        DISTRICT_CACHE_INFO["bytes"] -= entry[2]
+
+
+# evicts the least recently used entries until the cache fits its budget
+def district_cache_evict():
+    while DISTRICT_CACHE_INFO["bytes"] > DISTRICT_CACHE_INFO["max_bytes"]:
+        _, (_, _, nbytes, _) = DISTRICT_CACHE.popitem(last=False)
+        DISTRICT_CACHE_INFO["bytes"] -= nbytes
+
+
+def district_cache_info():
+    """Hits, misses, number of entries, estimated bytes and byte budget of the district cache."""
+    return dict(DISTRICT_CACHE_INFO, entries=len(DISTRICT_CACHE))
+
+
+def clear_district_cache():
+    """Empty the district cache and reset its hit and miss counts."""
+    DISTRICT_CACHE.clear()
+    DISTRICT_CACHE_INFO.update(hits=0, misses=0, bytes=0)
+
+
+def set_district_cache_limit(max_bytes):
+    """Set the byte budget of the district cache (0 disables it)."""
+    DISTRICT_CACHE_INFO["max_bytes"] = max_bytes
+    district_cache_evict()
+
+
+def read_district(district_name, last_name="", folder="", keys=None):
     """
     Read the JSON file for a given district.
 
+    Results are kept in the district cache (see district_cache_info) until the file changes,
+    so reading a district again, or a subset of the keys already read, does not parse it again. The returned dictionary is a
+    shallow copy: its values are shared with the cache and should not be modified in place.
+
     Parameters:
         district_name (str): Name of the district.
         last_name (str): Optional last name to append to the file name.
         folder (str): Optional folder path to look for the file.
+        keys (list): Optional top-level keys to read. The values of the other keys
+            are skipped without being parsed, and missing keys are left out.
 
     Returns:
         dict: Parsed JSON content of the district results.
@@ -86,13 +426,172 @@ def read_district(district_name, last_name="", folder=""):
     if not os.path.exists(district_file):
         raise FileNotFoundError(f"District {district_name} not found at '{district_file}'.")
 
+    cache_key = ("json", os.path.abspath(district_file))
+    signature = files_signature([district_file])[filename]
+    result = district_cache_get(cache_key, signature, keys)
+    if result is None:
+        with open(district_file, "r", encoding="utf-8") as f:
+            result = json.load(f) if keys is None else load_json_keys(f.read(), keys)
+        district_cache_put(cache_key, signature, result, keys)
+    return dict(result)
+
+# reads some fields of a district results file along with the signature of the file, so the
+# fields read by a worker process can be added to the district cache of the main process
+def read_district_file_keys(district_file, keys):
+    signature = files_signature([district_file])[os.path.basename(district_file)]
     with open(district_file, "r", encoding="utf-8") as f:
-        return json.load(f)
+        return signature, load_json_keys(f.read(), keys)
+
+
+# ballot-box ids and p-values of the fields of a district results file
+def district_pvalues(data):
+    ballots = data.get("ballotbox_id", [])
+    # check that ballots is not a list
+    if not isinstance(ballots, list):
+        ballots = [ballots]
+    return ballots, data.get("p_values", [])
 
-def load_pvalue_df():
+
+# modification time and size of every file, used to invalidate caches built from them
+# files are named by their path relative to root, or by their base name if no root is given
+def files_signature(files, root=None):
+    signature = {}
+    for file in files:
+        stat = os.stat(file)
+        name = os.path.basename(file) if root is None else os.path.relpath(file, root)
+        signature[name] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+# packed array cache of the results folders
+# every array key of a results folder is stored flat in output/cache/arrays/<folder>/<key>.npy
+# and index.json keeps the offset and shape of every district, plus the signature of the
+# .json files the cache was built from; the arrays are read as memory-mapped views
+ARRAYS_CACHE = os.path.join("output", "cache", "arrays")
+ARRAY_KEYS = ("X", "W", "W_agg", "prob")
+# packed caches opened in this process: folder -> (index, {key: memmap})
+ARRAYS_OPENED = {}
+
+
+def arrays_cache_folder(folder):
+    return os.path.join(ARRAYS_CACHE, os.path.basename(os.path.normpath(folder)))
+
+
+# builds the packed array cache of a results folder
+def build_arrays_cache(folder, signature):
+    cache_folder = arrays_cache_folder(folder)
+    os.makedirs(cache_folder, exist_ok=True)
+    districts = sorted(f[: -len(".json")] for f in signature)
+    data = []
+    for dist in districts:
+        # read directly, not through the district cache, as every district is read only once
+        with open(os.path.join(folder, f"{dist}.json"), "r", encoding="utf-8") as f:
+            data.append(load_json_keys(f.read(), ARRAY_KEYS))
+
+    index = {"signature": signature, "keys": {}}
+    for key in ARRAY_KEYS:
+        arrays = {dist: np.asarray(d[key]) for dist, d in zip(districts, data) if key in d}
+        if not arrays:
+            continue
+        entries, offset = {}, 0
+        for dist, array in arrays.items():
+            entries[dist] = [offset, list(array.shape)]
+            offset += array.size
+        flat = np.concatenate([array.ravel() for array in arrays.values()])
+        tmp_file = os.path.join(cache_folder, f"{key}.tmp.npy")
+        np.save(tmp_file, flat)
+        os.replace(tmp_file, os.path.join(cache_folder, f"{key}.npy"))
+        index["keys"][key] = entries
+
+    # the index is written last, so it never points to arrays that are not saved yet
+    tmp_file = os.path.join(cache_folder, "index.json.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, os.path.join(cache_folder, "index.json"))
+    return index
+
+
+# opens the packed array cache of a results folder, building it if it is missing or outdated
+def open_arrays_cache(folder, rebuild=False):
+    files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json")]
+    signature = files_signature(files)
+    cache_folder = arrays_cache_folder(folder)
+    index_file = os.path.join(cache_folder, "index.json")
+
+    index = None
+    if not rebuild and os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        if index["signature"] != signature:
+            index = None
+    if index is None:
+        ARRAYS_OPENED.pop(folder, None)  # release the old memory maps before replacing them
+        index = build_arrays_cache(folder, signature)
+
+    arrays = {key: np.load(os.path.join(cache_folder, f"{key}.npy"), mmap_mode="r") for key in index["keys"]}
+    ARRAYS_OPENED[folder] = (index, arrays)
+    return index, arrays
+
+
+def get_district_arrays(district_name, folder, keys=ARRAY_KEYS):
+    """
+    Get the arrays of a district from the packed array cache of its results folder.
+
+    The cache is built on first access and rebuilt when a .json file of the folder changes.
+
+    Parameters:
+        district_name (str): Name of the district.
+        folder (str): Results folder of the district.
+        keys (list): Array keys to get (subset of ARRAY_KEYS).
+
+    Returns:
+        dict: Read-only memory-mapped arrays by key (kept in the district cache). Keys
+            missing in the district are left out.
+
+    Raises:
+        FileNotFoundError: If the JSON file does not exist.
+    """
+    district_file = os.path.join(folder, f"{district_name}.json")
+    if not os.path.exists(district_file):
+        raise FileNotFoundError(f"District {district_name} not found at '{district_file}'.")
+
+    cache_key = ("arrays", os.path.abspath(district_file))
+    signature = files_signature([district_file])[f"{district_name}.json"]
+    result = district_cache_get(cache_key, signature, keys)
+    if result is not None:
+        return dict(result)
+
+    if folder in ARRAYS_OPENED:
+        index, arrays = ARRAYS_OPENED[folder]
+        # only the requested district is checked once the cache is opened
+        if index["signature"].get(f"{district_name}.json") != signature:
+            index, arrays = open_arrays_cache(folder)
+    else:
+        index, arrays = open_arrays_cache(folder)
+
+    result = {}
+    for key in keys:
+        entry = index["keys"].get(key, {}).get(district_name)
+        if entry is None:
+            continue
+        offset, shape = entry
+        result[key] = arrays[key][offset : offset + int(np.prod(shape))].reshape(shape)
+    district_cache_put(cache_key, signature, result, keys)
+    return dict(result)
+
+
+def load_pvalue_df(jobs=None, use_cache=True, catalog=None):
     """
     Load all election data from all disrtricts with p-value information
 
+    The district files are read in parallel by `jobs` processes (all cores by default),
+    their fields are added to the district cache and the frame is built in a single
+    allocation. If the Parquet store of the results folder was built (see
+    results_store.py) the p-values are read from the store instead. The result is
+    cached in PVALUE_CACHE and reused while no district file changes (mtime and size).
+    With `catalog` (path of a SQLite catalog, see catalog.py) the p-values are
+    queried from the catalog instead.
+
     Returns:
         pd.DataFrame: Combined DataFrame with p-values and ballotbox info.
     """
@@ -106,40 +605,100 @@ def load_pvalue_df():
         print("No results folder found. Please ensure JSONs are in ", RESULT_PATH)
         return pd.DataFrame()
 
+    # imported here as the results_store module imports aux_functions
+    from results_store import store_path, read_store_pvalues
+
+    if catalog is not None:
+        # imported here as the catalog module imports aux_functions
+        from catalog import connect, refresh_districts
+
+        conn = connect(catalog)
+        refresh_districts(conn, RESULT_PATH)
+        # fail as the district files do on ids and p-values of different lengths
+        mismatch = conn.execute(
+            "SELECT district, num_ballotbox_ids, num_pvalues FROM districts WHERE folder = ? AND num_pvalues > 0 "
+            "AND num_pvalues != num_ballotbox_ids ORDER BY district",
+            (os.path.normpath(RESULT_PATH),),
+        ).fetchone()
+        if mismatch is not None:
+            conn.close()
+            raise ValueError(f"District {mismatch[0]} has {mismatch[1]} ballot boxes but {mismatch[2]} p-values.")
+        rows = pd.read_sql_query(
+            "SELECT d.district, p.ballotbox_id, p.p_value, d.num_pvalues FROM pvalues p "
+            "JOIN districts d ON d.path = p.path WHERE d.folder = ? ORDER BY d.district, p.ballot",
+            conn,
+            params=(os.path.normpath(RESULT_PATH),),
+        )
+        conn.close()
+        return pd.DataFrame(
+            {
+                COLUMN_DISTRICT: pd.Categorical(rows["district"]),
+                COLUMN_BALLOTBOX: rows["ballotbox_id"].map(json.loads),
+                COLUMN_PVALUE: rows["p_value"].astype(np.float64),
+                COLUMN_NUM_BALLOTBOXES: rows["num_pvalues"].astype(np.int32),
+            }
+        )
+
     # Extract district names from .json files
-    districts = [
+    districts = sorted(
         f.split(".")[0] for f in os.listdir(RESULT_PATH) if f.endswith(".json")
-    ]
+    )
+    files = [os.path.join(RESULT_PATH, f"{dist}.json") for dist in districts]
+
+    # reuse the cached frame if no district file changed
+    signature = files_signature(files)
+    signature_file = os.path.splitext(PVALUE_CACHE)[0] + ".json"
+    if use_cache and os.path.exists(PVALUE_CACHE) and os.path.exists(signature_file):
+        with open(signature_file, "r") as f:
+            if json.load(f) == signature:
+                return pd.read_parquet(PVALUE_CACHE)
+
+    # the Parquet store of the folder, once built (see results_store.py), gives all the p-values
+    # without parsing the .json files; it is rebuilt first if one of them changed
+    if os.path.exists(store_path(RESULT_PATH)):
+        categories, counts, ballots, pvalues = read_store_pvalues(RESULT_PATH)
+    else:
+        # the districts already in the district cache are not read again; the others are read by
+        # the worker processes and added to the cache, so reading them again does not parse them
+        keys = ["ballotbox_id", "p_values"]
+        cache_keys = [("json", os.path.abspath(file)) for file in files]
+        data = [district_cache_get(cache_key, signature[f"{dist}.json"], keys)
+                for cache_key, dist in zip(cache_keys, districts)]
+        missing = [i for i, d in enumerate(data) if d is None]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            read = executor.map(read_district_file_keys, [files[i] for i in missing], [keys] * len(missing),
+                                chunksize=16)
+            for i, (file_signature, fields) in zip(missing, read):
+                district_cache_put(cache_keys[i], file_signature, fields, keys)
+                data[i] = fields
+        data = [district_pvalues(d) for d in data]
+
+        # districts without p-values are left out
+        kept = [(dist, ballots, pvals) for dist, (ballots, pvals) in zip(districts, data) if len(pvals) > 0]
+        for dist, ballots, pvals in kept:
+            if len(ballots) != len(pvals):
+                raise ValueError(f"District {dist} has {len(ballots)} ballot boxes but {len(pvals)} p-values.")
+        categories = [dist for dist, _, _ in kept]
+        counts = [len(pvals) for _, _, pvals in kept]
+        ballots = [b for _, ballots, _ in kept for b in ballots]
+        pvalues = np.fromiter((p for _, _, pvals in kept for p in pvals), dtype=np.float64, count=sum(counts))
+    counts = np.asarray(counts, dtype=np.int32)
+    codes = np.repeat(np.arange(len(categories), dtype=np.int32), counts)
 
     df_pais = pd.DataFrame(
-        columns=[
-            COLUMN_DISTRICT,
-            COLUMN_BALLOTBOX,
-            COLUMN_PVALUE,
-            COLUMN_NUM_BALLOTBOXES,
-        ]
+        {
+            COLUMN_DISTRICT: pd.Categorical.from_codes(codes, categories=categories),
+            COLUMN_BALLOTBOX: ballots,
+            COLUMN_PVALUE: pvalues,
+            COLUMN_NUM_BALLOTBOXES: counts[codes],
+        }
     )
-    
-    for dist in districts:
-        data = read_district(dist, folder=RESULT_PATH)
-
-        ballots = data.get("ballotbox_id", [])
-        pvals = data.get("p_values", [])
-        
-        # check that ballots is not a list
-        if not isinstance(ballots, list):
-            ballots = [ballots]
-        
-        df_dist = pd.DataFrame(
-            {
-                COLUMN_DISTRICT: dist,
-                COLUMN_BALLOTBOX: ballots,
-                COLUMN_PVALUE: pvals,
-                COLUMN_NUM_BALLOTBOXES: len(pvals),
-            }
-        )
 
-        df_pais = pd.concat([df_pais, df_dist], ignore_index=True)
+    if use_cache:
+        os.makedirs(os.path.dirname(PVALUE_CACHE), exist_ok=True)
+        df_pais.to_parquet(PVALUE_CACHE)
+        with open(signature_file, "w") as f:
+            json.dump(signature, f)
 
     return df_pais
 
@@ -0,0 +1,186 @@
+# SQLite catalog of the runs saved in output/
+# one row per result file of output/simulated_instances and output/results_districts*, with its
+# configuration, status, time, iterations, logLik, error metrics and content hash, plus the
+# p-value of every ballot box, so questions like "which runs did not converge" or "which
+# districts lack p-values" are answered without opening any JSON
+# the catalog is refreshed incrementally: only files whose mtime or size changed are read again
+
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+
+from aux_functions import SIMULATION_FOLDER
+
+CATALOG_FILE = os.path.join("output", "catalog.sqlite")
+SIMULATIONS_DIR = os.path.join("output", "simulated_instances")
+RESULTS_DIRS = [os.path.join("output", folder) for folder in
+                ("results_districts", "results_districts_age40", "results_districts_sex")]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS simulations (
+    path TEXT PRIMARY KEY, root TEXT, I INTEGER, B INTEGER, G INTEGER, C INTEGER, lambda REAL,
+    method TEXT, run TEXT, seed INTEGER, status INTEGER, message TEXT, time REAL, iterations INTEGER,
+    logLik REAL, mean_error REAL, max_error REAL, sha256 TEXT, mtime_ns INTEGER, size INTEGER
+);
+CREATE TABLE IF NOT EXISTS districts (
+    path TEXT PRIMARY KEY, folder TEXT, district TEXT, status INTEGER, message TEXT, time REAL,
+    iterations INTEGER, logLik REAL, group_agg TEXT, num_ballots INTEGER, num_pvalues INTEGER,
+    num_ballotbox_ids INTEGER, sha256 TEXT, mtime_ns INTEGER, size INTEGER
+);
+CREATE TABLE IF NOT EXISTS pvalues (
+    path TEXT, ballot INTEGER, ballotbox_id TEXT, p_value REAL, PRIMARY KEY (path, ballot)
+);
+CREATE INDEX IF NOT EXISTS simulations_config ON simulations (G, C, lambda, method);
+CREATE INDEX IF NOT EXISTS districts_folder ON districts (folder);
+"""
+# version of the tables above; the district tables of an older catalog are dropped and read again
+# from the files (version 2 stores the ballot-box ids as JSON and counts them per district)
+SCHEMA_VERSION = 2
+
+
+def connect(catalog_file=CATALOG_FILE):
+    os.makedirs(os.path.dirname(catalog_file) or ".", exist_ok=True)
+    conn = sqlite3.connect(catalog_file)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        conn.executescript("DROP TABLE IF EXISTS districts; DROP TABLE IF EXISTS pvalues;")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# reads a result file, returning its parsed content and the sha256 of its bytes
+def read_hashed(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    return json.loads(content), hashlib.sha256(content).hexdigest()
+
+
+# paths whose mtime or size differ from the catalog, and catalog paths that no longer exist
+def changed_files(conn, table, scope_column, scope, files):
+    stored = {path: (mtime_ns, size) for path, mtime_ns, size in
+              conn.execute(f"SELECT path, mtime_ns, size FROM {table} WHERE {scope_column} = ?", (scope,))}
+    changed = []
+    for path in files:
+        stat = os.stat(path)
+        if stored.get(path) != (stat.st_mtime_ns, stat.st_size):
+            changed.append(path)
+    return changed, set(stored) - set(files)
+
+
+def simulation_row(path, root, config, method, run):
+    data, sha256 = read_hashed(path)
+    mean_error = max_error = None
+    if "real_prob" in data and "prob" in data:
+        p_real, p_est = np.array(data["real_prob"], dtype=float), np.array(data["prob"], dtype=float)
+        if p_real.shape == p_est.shape:
+            mean_error, max_error = float(np.mean(np.abs(p_real - p_est))), float(np.max(np.abs(p_real - p_est)))
+    stat = os.stat(path)
+    I, B, G, C, lambda_code = map(int, config.groups())
+    return (path, root, I, B, G, C, lambda_code / 100, method, run, int(run) if run.isdigit() else None,
+            data.get("status"), data.get("message"), data.get("time"), data.get("iterations"),
+            data.get("logLik"), mean_error, max_error, sha256, stat.st_mtime_ns, stat.st_size)
+
+
+def refresh_simulations(conn, output_dir=SIMULATIONS_DIR):
+    """Update the simulations table with the result files of output_dir that changed."""
+    root = os.path.normpath(output_dir)
+    runs = {}
+    for folder in os.scandir(root):
+        config = SIMULATION_FOLDER.fullmatch(folder.name)
+        if config is None or not folder.is_dir():
+            continue
+        for method in os.scandir(folder.path):
+            if not method.is_dir():
+                continue
+            for file in os.scandir(method.path):
+                if file.name.endswith(".json"):
+                    runs[os.path.normpath(file.path)] = (config, method.name, file.name[: -len(".json")])
+
+    changed, removed = changed_files(conn, "simulations", "root", root, list(runs))
+    conn.executemany("DELETE FROM simulations WHERE path = ?", [(path,) for path in removed])
+    rows = []
+    for path in changed:
+        try:
+            rows.append(simulation_row(path, root, *runs[path]))
+        except (OSError, ValueError):
+            continue  # unreadable file, retried on the next refresh
+    conn.executemany(f"INSERT OR REPLACE INTO simulations VALUES ({', '.join('?' * 20)})", rows)
+    conn.commit()
+    return len(rows), len(removed)
+
+
+def refresh_districts(conn, folder):
+    """Update the districts and pvalues tables with the district files of folder that changed."""
+    folder = os.path.normpath(folder)
+    files = [os.path.normpath(os.path.join(folder, f)) for f in os.listdir(folder) if f.endswith(".json")]
+    changed, removed = changed_files(conn, "districts", "folder", folder, files)
+    for path in removed | set(changed):
+        conn.execute("DELETE FROM districts WHERE path = ?", (path,))
+        conn.execute("DELETE FROM pvalues WHERE path = ?", (path,))
+
+    updated = 0
+    for path in changed:
+        try:
+            data, sha256 = read_hashed(path)
+        except (OSError, ValueError):
+            continue
+        stat = os.stat(path)
+        ballots = data.get("ballotbox_id", [])
+        if not isinstance(ballots, list):
+            ballots = [ballots]
+        p_values = data.get("p_values")
+        group_agg = data.get("group_agg")
+        conn.execute(
+            f"INSERT INTO districts VALUES ({', '.join('?' * 15)})",
+            (path, folder, os.path.basename(path)[: -len(".json")], data.get("status"), data.get("message"),
+             data.get("time"), data.get("iterations"), data.get("logLik"),
+             None if group_agg is None else json.dumps(group_agg), len(data.get("X", [])),
+             None if p_values is None else len(p_values), len(ballots), sha256, stat.st_mtime_ns, stat.st_size),
+        )
+        # the ids are stored as JSON, so they are read back with the type they have in the file;
+        # districts whose ids and p-values differ in length get no rows (load_pvalue_df raises on them)
+        if p_values is not None and len(p_values) == len(ballots):
+            conn.executemany("INSERT INTO pvalues VALUES (?, ?, ?, ?)",
+                             [(path, i, json.dumps(b), p) for i, (b, p) in enumerate(zip(ballots, p_values))])
+        updated += 1
+    conn.commit()
+    return updated, len(removed)
+
+
+def refresh_catalog(catalog_file=CATALOG_FILE, simulations_dir=SIMULATIONS_DIR, results_dirs=RESULTS_DIRS):
+    """Refresh the whole catalog. Returns the number of updated and removed files."""
+    conn = connect(catalog_file)
+    updated = removed = 0
+    if os.path.isdir(simulations_dir):
+        updated, removed = refresh_simulations(conn, simulations_dir)
+    for folder in results_dirs:
+        if os.path.isdir(folder):
+            u, r = refresh_districts(conn, folder)
+            updated, removed = updated + u, removed + r
+    conn.close()
+    return updated, removed
+
+
+# main: refreshes the catalog and summarizes what is missing
+if __name__ == "__main__":
+    updated, removed = refresh_catalog()
+    print(f"Catalog {CATALOG_FILE}: {updated} files updated, {removed} removed")
+    conn = connect()
+    print("Simulation runs with status != 0 by (G, C, lambda, method):")
+    for row in conn.execute("SELECT G, C, lambda, method, COUNT(*) FROM simulations WHERE status != 0 "
+                            "GROUP BY G, C, lambda, method ORDER BY G, C, lambda, method"):
+        print("   ", row)
+    print("Districts without p-values:")
+    for folder, count in conn.execute("SELECT folder, COUNT(*) FROM districts WHERE num_pvalues IS NULL GROUP BY folder"):
+        print(f"    {folder}: {count}")
+    conn.close()
+
+    # the p-values read from the catalog must be those read from the district files
+    from aux_functions import load_pvalue_df
+
+    from_catalog = load_pvalue_df(catalog=CATALOG_FILE)
+    from_files = load_pvalue_df(use_cache=False)
+    assert from_catalog.equals(from_files), "load_pvalue_df differs between the catalog and the district files"
+    print(f"load_pvalue_df: catalog and district files agree on {len(from_files)} ballot boxes")
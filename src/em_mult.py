@@ -0,0 +1,464 @@
+# EM algorithm for ecological inference with the multinomial approximation of the E-step, the
+# "mult" method of fastei::run_em, written with NumPy so a district can be estimated, tested and
+# plotted from Python without starting R or going through .json files
+#   - the E-step of all ballot boxes is computed at once on (B, G, C) arrays, and em_batch runs
+#     many weighted copies of a district together (bootstrap resamples, group aggregations)
+#   - run_em returns the fields save_eim writes (prob, iterations, logLik, status, message, time)
+#     and save_em writes them in the same .json layout
+#   - a coarser aggregation can be warm-started from the solution of a finer one that nests it
+#     (merge_probabilities); run_em_nested and get_agg_opt do it on request (warm_start)
+#   - the log-likelihood of the "mult" approximation is not monotone: like fastei, the algorithm
+#     also stops when it decreases after miniter iterations
+# on the saved district results (output/results_districts*) prob, iterations and logLik agree with
+# fastei up to ~1e-11
+
+import itertools
+import json
+import time
+import numpy as np
+from scipy.special import gammaln
+
+STATUS_MESSAGES = {0: "Converged", 1: "Maximum time reached", 2: "Maximum iterations reached"}
+INITIAL_PROBS = ("group_proportional", "proportional", "uniform", "random")
+
+
+# sums the columns of W into the macro-groups of group_agg, given in R notation:
+# group_agg lists the last (1-based) group of every macro-group, e.g. [3, 7, 8]
+def aggregate_groups(W, group_agg):
+    W = np.asarray(W)
+    cuts = [0] + [int(g) for g in np.atleast_1d(group_agg)]
+    if cuts[-1] != W.shape[-1] or any(a >= b for a, b in zip(cuts[:-1], cuts[1:])):
+        raise ValueError(f"Invalid group_agg {list(cuts[1:])} for {W.shape[-1]} groups.")
+    return np.add.reduceat(W, cuts[:-1], axis=-1)
+
+
+def initial_probabilities(X, W, counts, initial_prob="group_proportional", seed=None):
+    """
+    Starting (R, G, C) probabilities of the copies of em_batch, as the initial_prob options of fastei.
+
+    group_proportional: vote shares of every ballot box averaged with the voters of each group.
+    proportional: the vote shares of the whole district for every group.
+    uniform: 1 / C.
+    random: uniform draws normalized by row, from a generator seeded with seed.
+    An array of (G, C) or (R, G, C) probabilities is used as given.
+    """
+    R, G, C = counts.shape[0], W.shape[2], X.shape[1]
+    if not isinstance(initial_prob, str):
+        return np.broadcast_to(np.asarray(initial_prob, dtype=float), (R, G, C)).copy()
+    if initial_prob == "group_proportional":
+        shares = X / np.maximum(X.sum(axis=1, keepdims=True), 1)
+        voters = counts[:, :, None] * W
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.einsum("rbg,bc->rgc", voters, shares) / voters.sum(axis=1)[:, :, None]
+    if initial_prob == "proportional":
+        votes = counts @ X
+        return np.repeat((votes / votes.sum(axis=1, keepdims=True))[:, None, :], G, axis=1)
+    if initial_prob == "uniform":
+        return np.full((R, G, C), 1 / C)
+    if initial_prob == "random":
+        prob = np.random.default_rng(seed).random((G, C))
+        return np.repeat((prob / prob.sum(axis=1, keepdims=True))[None], R, axis=0)
+    raise ValueError(f"Unknown initial_prob '{initial_prob}', expected one of {INITIAL_PROBS}.")
+
+
+# log-likelihood of every copy, as computed by fastei: the multinomial coefficient (log_coef) uses
+# the votes of every ballot box and the vote shares are taken over its voters in W
+def log_likelihood(X, W, expected, counts, log_coef):
+    shares = expected / W.sum(axis=2, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_shares = np.log(np.where(X > 0, shares, 1))
+    return log_coef + np.einsum("rb,rbc,bc->r", counts, log_shares, X)
+
+
+# E- and M-step of the "mult" method for all ballot boxes of all copies at once
+# the E-step gives q[r, b, g, c] proportional to t = p[g, c] * x[b, c] / (e[b, c] - p[g, c]), with
+# e = W @ p the expected votes of the ballot box, and 0 for the candidates without votes; the new
+# probabilities are the q averaged with the weighted voters, so q is never normalized: the
+# normalization goes into the weights of the average
+def em_step(X, prob, expected, weighted, voters):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = expected[:, :, None, :] - prob[:, None, :, :]
+        np.divide(X[None, :, None, :], t, out=t)
+        t *= prob[:, None, :, :]
+        np.copyto(t, 0, where=X[None, :, None, :] == 0)
+        total = t.sum(axis=3)
+        singular = ~np.isfinite(total)
+        if singular.any():  # a group alone in the ballot box, whose q is left at 0
+            t[singular] = 0
+        weights = np.where((total > 0) & ~singular, weighted / total, 0)
+    return np.einsum("rbg,rbgc->rgc", weights, t) / voters
+
+
+def em_batch(
+    X,
+    W,
+    counts=None,
+    initial_prob="group_proportional",
+    param_threshold=0.001,
+    ll_threshold=-np.inf,
+    maxiter=1000,
+    miniter=50,
+    maxtime=3600,
+    seed=None,
+):
+    """
+    Run the "mult" EM algorithm on R weighted copies of a district at once.
+
+    Copy r has the voters W[r] (or W[0] for all) and counts ballot box b counts[r, b] times, so a
+    bootstrap resample is a row of counts and the aggregations of a district are rows of W. Every
+    copy stops on its own, with the rules of run_em.
+
+    Parameters:
+        X (array): (B, C) votes of every candidate in every ballot box.
+        W (array): (R, B, G) or (1, B, G) voters of every group in every ballot box.
+        counts (array): Optional (R, B) weights of the ballot boxes, 1 by default.
+        The other parameters are those of run_em.
+
+    Returns:
+        dict: (R, G, C) prob and (R,) iterations, logLik and status of the copies, plus the total
+              time. Copies in which a group has no voters get nan probabilities and logLik.
+    """
+    start = time.perf_counter()
+    X = np.asarray(X, dtype=float)
+    W = np.asarray(W, dtype=float)
+    R = max(W.shape[0], 1 if counts is None else counts.shape[0])
+    W = np.broadcast_to(W, (R,) + W.shape[1:])
+    counts = np.ones((R, X.shape[0])) if counts is None else np.broadcast_to(counts, (R, X.shape[0]))
+    weighted = counts[:, :, None] * W
+    voters = weighted.sum(axis=1)[:, :, None]
+    box_coef = gammaln(X.sum(axis=1) + 1) - np.sum(gammaln(X + 1), axis=1)
+
+    prob = initial_probabilities(X, W, counts, initial_prob, seed)
+    logLik = np.full(R, -np.inf)
+    iterations = np.zeros(R, dtype=int)
+    status = np.full(R, 2)
+    active = np.flatnonzero(np.all(voters > 0, axis=(1, 2)))
+    prob[np.setdiff1d(np.arange(R), active)] = np.nan
+    logLik[np.setdiff1d(np.arange(R), active)] = np.nan
+    # arrays of the copies still running
+    W_a, counts_a, weighted_a, voters_a = W[active], counts[active], weighted[active], voters[active]
+    log_coef_a, prob_a, logLik_a = counts_a @ box_coef, prob[active], logLik[active]
+    iteration = 0
+    while active.size and iteration < maxiter:
+        iteration += 1
+        expected = W_a @ prob_a
+        new_prob = em_step(X, prob_a, expected, weighted_a, voters_a)
+        logLik_a, logLik_prev = log_likelihood(X, W_a, expected, counts_a, log_coef_a), logLik_a
+        change = np.max(np.abs(new_prob - prob_a), axis=(1, 2))
+        prob_a = new_prob
+        prob[active], logLik[active], iterations[active] = prob_a, logLik_a, iteration
+        done = ((change < param_threshold) | (np.abs(logLik_a - logLik_prev) < ll_threshold)
+                | ((iteration > miniter) & (logLik_a < logLik_prev)))
+        status[active[done]] = 0
+        if time.perf_counter() - start > maxtime:
+            status[active[~done]] = 1
+            break
+        if done.any():
+            keep = ~done
+            active, W_a, counts_a, weighted_a, voters_a = (
+                active[keep], W_a[keep], counts_a[keep], weighted_a[keep], voters_a[keep])
+            log_coef_a, prob_a, logLik_a = log_coef_a[keep], prob_a[keep], logLik_a[keep]
+
+    return {
+        "prob": prob,
+        # counted as fastei does, which leaves out the last update
+        "iterations": np.maximum(iterations - 1, 1),
+        "logLik": logLik,
+        "status": status,
+        "time": time.perf_counter() - start,
+    }
+
+
+def run_em(
+    X,
+    W,
+    group_agg=None,
+    initial_prob="group_proportional",
+    param_threshold=0.001,
+    ll_threshold=-np.inf,
+    maxiter=1000,
+    miniter=50,
+    maxtime=3600,
+    seed=None,
+):
+    """
+    Estimate the voting probabilities of a district with the "mult" EM algorithm.
+
+    Parameters:
+        X (array): (B, C) votes of every candidate in every ballot box.
+        W (array): (B, G) voters of every group in every ballot box, or (B,) for a single group.
+        group_agg (list): Optional macro-groups in R notation (see aggregate_groups).
+        initial_prob (str): One of INITIAL_PROBS (see initial_probabilities), or (G, C) probabilities.
+        param_threshold (float): Stop when no probability changes more than this.
+        ll_threshold (float): Stop when the log-likelihood changes less than this.
+        maxiter (int): Maximum number of iterations.
+        miniter (int): Iterations after which a decrease of the log-likelihood stops the algorithm.
+        maxtime (float): Maximum running time, in seconds.
+        seed (int): Seed of the random initial_prob.
+
+    Returns:
+        dict: The fields of save_eim: X, W (and W_agg, group_agg) with the dtype they were given,
+              so integer votes can go on to the p-values, prob, iterations, logLik, time, message,
+              status and the parameters of the run.
+
+    Raises:
+        ValueError: If a group has no voters or an argument is invalid.
+    """
+    start = time.perf_counter()
+    X = np.asarray(X)
+    W = np.asarray(W)
+    if W.ndim == 1:
+        W = W[:, None]
+    W_em = W if group_agg is None else aggregate_groups(W, group_agg)
+    if np.any(W_em.sum(axis=0) == 0):
+        raise ValueError("Every group must have at least one voter.")
+
+    batch = em_batch(X, W_em[None], initial_prob=initial_prob, param_threshold=param_threshold,
+                     ll_threshold=ll_threshold, maxiter=maxiter, miniter=miniter, maxtime=maxtime, seed=seed)
+    status = int(batch["status"][0])
+    result = {"X": X, "W": W}
+    if group_agg is not None:
+        result["W_agg"] = W_em
+        result["group_agg"] = [int(g) for g in np.atleast_1d(group_agg)]
+    result.update({
+        "method": "mult",
+        "prob": batch["prob"][0],
+        "iterations": int(batch["iterations"][0]),
+        "logLik": float(batch["logLik"][0]),
+        "time": time.perf_counter() - start,
+        "message": STATUS_MESSAGES[status],
+        "status": status,
+        "maxiter": maxiter,
+        "miniter": miniter,
+        "maxtime": maxtime,
+        "param_threshold": param_threshold,
+        "ll_threshold": ll_threshold,
+        "initial_prob": initial_prob,
+    })
+    return result
+
+
+# all the contiguous aggregations of G groups in R notation (2^(G - 1)): every subset of the G - 1
+# possible cuts followed by G, from [G] (a single group) to [1, 2, ..., G]
+def contiguous_aggregations(G):
+    return [list(cuts) + [G] for k in range(G) for cuts in itertools.combinations(range(1, G), k)]
+
+
+# starting probabilities of a coarser aggregation from the (G, C) solution of a finer one that
+# nests it (every cut of coarse_agg is a cut of fine_agg): the probabilities of the fine macro-groups
+# inside every coarse macro-group, weighted by their voters (the column sums of the fine W_agg)
+def merge_probabilities(prob, voters, fine_agg, coarse_agg):
+    fine_agg, coarse_agg = np.atleast_1d(fine_agg), np.atleast_1d(coarse_agg)
+    if not set(coarse_agg) <= set(fine_agg):
+        raise ValueError(f"group_agg {list(coarse_agg)} is not nested in {list(fine_agg)}.")
+    # coarse macro-group of every fine macro-group, the first whose last group is not before it
+    membership = np.searchsorted(np.sort(coarse_agg), fine_agg)
+    merged = np.zeros((len(coarse_agg), prob.shape[1]))
+    np.add.at(merged, membership, voters[:, None] * prob)
+    return merged / np.bincount(membership, weights=voters, minlength=len(coarse_agg))[:, None]
+
+
+# closest (fewest macro-groups) of the aggregations already solved that nests group_agg, or None
+def nesting_aggregation(group_agg, solved):
+    nesting = [fine_agg for fine_agg in solved if set(group_agg) <= set(fine_agg)]
+    return min(nesting, key=len) if nesting else None
+
+
+def run_em_nested(X, W, group_aggs, warm_start=False, **em_args):
+    """
+    Run the EM of several aggregations of a district, from the finest to the coarsest.
+
+    With warm_start, every aggregation starts from the merged probabilities (see
+    merge_probabilities) of the closest aggregation already solved that nests it, if any; the others
+    start from em_args["initial_prob"]. Every result records its iterations and time, plus the
+    aggregation it was started from (warm_start_from, None for a cold start). A warm-started EM
+    needs fewer iterations but stops at a slightly different point within param_threshold.
+
+    Returns:
+        list: The run_em results, in the order of group_aggs.
+    """
+    W = np.asarray(W)
+    group_aggs = [tuple(int(g) for g in np.atleast_1d(group_agg)) for group_agg in group_aggs]
+    solved = {}
+    for group_agg in sorted(group_aggs, key=len, reverse=True):
+        fine_agg = nesting_aggregation(group_agg, solved) if warm_start else None
+        args = dict(em_args)
+        if fine_agg is not None:
+            fine = solved[fine_agg]
+            args["initial_prob"] = merge_probabilities(fine["prob"], fine["W_agg"].sum(axis=0), fine_agg, group_agg)
+        solved[group_agg] = run_em(X, W, group_agg=list(group_agg), **args)
+        solved[group_agg]["warm_start_from"] = None if fine_agg is None else list(fine_agg)
+    return [solved[group_agg] for group_agg in group_aggs]
+
+
+def bootstrap(X, W, group_agg=None, nboot=100, seed=42, samples=None, sd_threshold=None,
+              abort_factor=1.5, min_boot=20, **em_args):
+    """
+    Standard deviation of the EM probabilities over nboot resamples of the ballot boxes.
+
+    The resamples are run together by em_batch, as counts of every ballot box. samples is an
+    optional (nboot, B) array with the ballot boxes of every resample, so different aggregations
+    can share them; otherwise they are drawn with seed. With sd_threshold, the first min_boot
+    resamples are run alone and the rest is skipped if their largest standard deviation already
+    exceeds abort_factor * sd_threshold.
+
+    Returns:
+        tuple: (G, C) standard deviations and the number of resamples done. The deviations are inf
+               if a resample leaves a group without voters, or if all the resamples are identical
+               (always the case with a single ballot box), as they say nothing about the spread.
+    """
+    X = np.asarray(X)
+    W = np.asarray(W)
+    W_em = W if group_agg is None else aggregate_groups(W, group_agg)
+    B = X.shape[0]
+    if samples is None:
+        samples = np.random.default_rng(seed).integers(0, B, size=(nboot, B))
+    counts = np.zeros((nboot, B))
+    np.add.at(counts, (np.arange(nboot)[:, None], samples[:nboot]), 1)
+    if np.all(counts == counts[0]):
+        return np.full((W_em.shape[1], X.shape[1]), np.inf), 0
+
+    chunks = [counts] if sd_threshold is None or min_boot >= nboot else [counts[:min_boot], counts[min_boot:]]
+    probs = np.empty((0,) + (W_em.shape[1], X.shape[1]))
+    for chunk in chunks:
+        probs = np.concatenate([probs, em_batch(X, W_em[None], chunk, **em_args)["prob"]])
+        if np.isnan(probs).any():  # a group without voters in a resample
+            return np.full(probs.shape[1:], np.inf), len(probs)
+        sd = np.std(probs, axis=0, ddof=1)
+        if sd_threshold is not None and np.max(sd) > abort_factor * sd_threshold:
+            break
+    return sd, len(probs)
+
+
+def get_agg_opt(X, W, sd_threshold=0.05, nboot=100, seed=42, param_threshold=0.0001,
+                abort_factor=1.5, min_boot=20, warm_start=False, **em_args):
+    """
+    Contiguous aggregation of the groups of W with the highest log-likelihood among those whose
+    bootstrapped probabilities have a standard deviation below sd_threshold, following
+    fastei::get_agg_opt: if none qualifies, the groups are fully aggregated ([G]).
+
+    The EM of all the aggregations with the same number of macro-groups is run at once, from the
+    finest to the coarsest; with warm_start, each aggregation starts from the merged solution of
+    the nesting aggregation with one more macro-group and the highest log-likelihood (see
+    merge_probabilities). Warm start is faster but moves every log-likelihood within
+    param_threshold, which can swap near-ties and change the aggregation chosen (CHANAVAYITA
+    gives [8] instead of [6, 8]), so it is off by default. The aggregations are bootstrapped from
+    the highest log-likelihood down, so the search stops at the first one that meets the
+    threshold, and the bootstrap of an aggregation stops early once it is clearly above it (see
+    bootstrap). The resamples are not warm-started,
+    since starting them at the estimate would shrink their spread; all the aggregations share the
+    same resamples of the ballot boxes, and the chosen one is estimated again with initial_prob.
+
+    The resamples are drawn with NumPy, not with R's generator, so the choice can differ from
+    fastei's when the largest standard deviation of a candidate is close to sd_threshold: in
+    PORTEZUELO and ANDALIEN the candidates that decide it range from 0.044 to 0.060 over seeds 42
+    to 49, and fastei chose [4, 8] and [2, 3, 6, 8] where seed 42 gives [3, 5, 8] and
+    [2, 3, 4, 5, 8].
+
+    Returns:
+        dict: The run_em result of the chosen aggregation with its sd and nboot, the number of
+              aggregations bootstrapped (candidates) and the iterations and time of the EM of all
+              the aggregations (search_iterations, search_em_time).
+    """
+    X = np.asarray(X)
+    W = np.asarray(W)
+    G = W.shape[1]
+    em_args["param_threshold"] = param_threshold
+    initial_prob = em_args.pop("initial_prob", "group_proportional")
+    voters = W.sum(axis=0)
+    solved = {}  # aggregation: (logLik, prob)
+    search_iterations, search_em_time = 0, 0.0
+    aggregations = contiguous_aggregations(G)
+    for size in range(G, 0, -1):
+        group_aggs = [group_agg for group_agg in aggregations if len(group_agg) == size]
+        W_aggs = np.stack([aggregate_groups(W, group_agg) for group_agg in group_aggs])
+        initial = initial_prob
+        if warm_start and size < G:
+            initial = initial_probabilities(X, W_aggs, np.ones((len(group_aggs), X.shape[0])), initial_prob,
+                                            em_args.get("seed"))
+            for k, group_agg in enumerate(group_aggs):
+                parents = [tuple(sorted(group_agg + [cut])) for cut in range(1, G) if cut not in group_agg]
+                parents = [parent for parent in parents if parent in solved]
+                if parents:
+                    parent = max(parents, key=lambda parent: solved[parent][0])
+                    initial[k] = merge_probabilities(solved[parent][1], aggregate_groups(voters, parent),
+                                                     parent, group_agg)
+        batch = em_batch(X, W_aggs, initial_prob=initial, **em_args)
+        search_iterations += int(batch["iterations"].sum())
+        search_em_time += batch["time"]
+        # aggregations with a macro-group without voters (nan logLik) are left out
+        solved.update((tuple(group_agg), (logLik, prob)) for group_agg, logLik, prob
+                      in zip(group_aggs, batch["logLik"], batch["prob"]) if not np.isnan(logLik))
+    ranking = sorted(solved, key=lambda group_agg: solved[group_agg][0], reverse=True)
+
+    samples = np.random.default_rng(seed).integers(0, X.shape[0], size=(nboot, X.shape[0]))
+    sds = {}
+    for group_agg in ranking:
+        sds[group_agg], _ = bootstrap(X, W, list(group_agg), nboot, samples=samples, sd_threshold=sd_threshold,
+                                      abort_factor=abort_factor, min_boot=min_boot, initial_prob=initial_prob,
+                                      **em_args)
+        if np.max(sds[group_agg]) < sd_threshold:
+            break
+    else:
+        group_agg = (G,)  # none qualifies: a single macro-group, as fastei
+    result = run_em(X, W, group_agg=list(group_agg), initial_prob=initial_prob, **em_args)
+    result.update({"sd": sds.get(group_agg, np.full((len(group_agg), X.shape[1]), np.inf)), "nboot": nboot,
+                   "sd_threshold": sd_threshold, "candidates": len(sds), "warm_start": warm_start,
+                   "search_iterations": search_iterations, "search_em_time": search_em_time})
+    return result
+
+
+# converts arrays to lists and infinite numbers to "Inf"/"-Inf", as jsonlite does in save_eim
+def to_json_value(value):
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, list):
+        return [to_json_value(v) for v in value]
+    if isinstance(value, (float, np.floating)) and np.isinf(value):
+        return "Inf" if value > 0 else "-Inf"
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def save_em(result, filename):
+    """Save the result of run_em (plus any added fields) to a .json file like save_eim."""
+    with open(filename, "w") as f:
+        json.dump({key: to_json_value(value) for key, value in result.items()}, f)
+
+
+# main: estimates again the districts of output/figure4, compares them with fastei and with the
+# EM warm-started across their nested aggregations, and checks the aggregations that get_agg_opt
+# chooses against those saved by fastei::get_agg_opt for a few districts (single and few ballot
+# boxes, near-ties in logLik)
+if __name__ == "__main__":
+    import glob
+    import os
+
+    districts = {}
+    for file in sorted(glob.glob(os.path.join("output", "figure4", "*.json"))):
+        with open(file, "r") as f:
+            district = json.load(f)
+        result = run_em(district["X"], district["W"], group_agg=district["group_agg"],
+                        param_threshold=district["param_threshold"])
+        error = np.max(np.abs(result["prob"] - np.array(district["prob"])))
+        print(f"{os.path.basename(file)[: -len('.json')]:<32} iterations {result['iterations']:>4} "
+              f"({district['iterations']:>4})  logLik {result['logLik']:.4f} ({district['logLik']:.4f})  "
+              f"max |prob - fastei| {error:.1e}  {1000 * result['time']:.1f} ms")
+        name = os.path.basename(file).rsplit("_", len(np.atleast_1d(district["group_agg"])))[0]
+        districts.setdefault(name, (district["X"], district["W"], []))[2].append(district["group_agg"])
+
+    for name, (X, W, group_aggs) in districts.items():
+        for warm_start in (False, True):
+            results = run_em_nested(X, W, group_aggs, warm_start=warm_start, param_threshold=0.0001)
+            print(f"{name:<12} {'warm' if warm_start else 'cold'}  iterations "
+                  f"{[result['iterations'] for result in results]} = {sum(r['iterations'] for r in results):>4}  "
+                  f"{1000 * sum(result['time'] for result in results):.1f} ms")
+
+    for name in ("ANTARTICA", "ISLA MAILLEN", "CHANAVAYITA", "RIO TRANQUILO"):
+        with open(os.path.join("output", "results_districts", f"{name}.json"), "r") as f:
+            district = json.load(f)
+        result = get_agg_opt(district["X"], district["W"], sd_threshold=0.05, nboot=100, param_threshold=0.0001)
+        saved = [int(g) for g in np.atleast_1d(district["group_agg"])]
+        assert result["group_agg"] == saved, f"{name}: get_agg_opt gives {result['group_agg']}, fastei {saved}"
+        print(f"{name:<16} group_agg {result['group_agg']} (fastei {saved})  {result['candidates']} candidates")
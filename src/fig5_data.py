@@ -0,0 +1,89 @@
+# Python version of fig5_data.R / fig5_data.sh: finds the optimal group aggregation of every
+# district with em_mult.get_agg_opt (sd_threshold 0.05, nboot 100, param_threshold 0.0001) and
+# saves it as the .json files read by fig5_triple.get_all_group_aggregations
+#   - the 2^7 contiguous aggregations of the 8 age groups are ranked by log-likelihood and only
+#     bootstrapped until one meets the threshold; bootstraps clearly above it stop early
+#   - the saved files record the iterations and time of the EM of all the aggregations
+#     (search_iterations, search_em_time); with warm_start, each one starts from a finer one, which
+#     is faster but can change the aggregation chosen between near-ties (see em_mult.get_agg_opt)
+#   - if no aggregation qualifies, get_agg_opt fully aggregates the groups ([8]), as fastei does
+#   - districts are processed by `jobs` worker processes, largest first, and saved as they finish;
+#     districts already saved are skipped, as in fig5_data.sh, so a run can be resumed
+# the votes (X) and voters (W) of every district are read from the saved results of SOURCE_FOLDER
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm
+from aux_functions import read_district
+from em_mult import get_agg_opt, save_em
+
+SOURCE_FOLDER = os.path.join("output", "results_districts")
+OUTPUT_FOLDER = os.path.join("output", "results_districts_search")
+INPUT_KEYS = ["X", "W", "ballotbox_id", "candidates_id", "group_id"]
+
+
+# optimal aggregation of a district
+def search_district(district_name, district, options):
+    start = time.perf_counter()
+    result = get_agg_opt(district["X"], district["W"], **options)
+    for key in INPUT_KEYS[2:]:
+        if key in district:
+            result[key] = district[key]
+    result["search_time"] = time.perf_counter() - start
+    return district_name, result
+
+
+# writes and renames, so an interrupted run never leaves a truncated district file
+def save_district(result, output_folder, district_name):
+    results_file = os.path.join(output_folder, f"{district_name}.json")
+    save_em(result, results_file + ".tmp")
+    os.replace(results_file + ".tmp", results_file)
+
+
+def search_all_districts(source_folder=SOURCE_FOLDER, output_folder=OUTPUT_FOLDER, jobs=None,
+                         load_bar=False, sd_threshold=0.05, nboot=100, param_threshold=0.0001, seed=42,
+                         warm_start=False):
+    """
+    Find and save the optimal group aggregation of every district of source_folder.
+
+    Districts already in output_folder are skipped. jobs is the number of worker processes (all
+    cores by default, 1 runs in this process). Returns the names of the districts processed.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    options = dict(sd_threshold=sd_threshold, nboot=nboot, param_threshold=param_threshold, seed=seed,
+                   warm_start=warm_start)
+    done = {f[: -len(".json")] for f in os.listdir(output_folder) if f.endswith(".json")}
+    districts = {}
+    for file in sorted(os.listdir(source_folder)):
+        district_name = file[: -len(".json")]
+        if file.endswith(".json") and district_name not in done:
+            district = read_district(district_name, folder=source_folder, keys=INPUT_KEYS)
+            district["X"], district["W"] = np.array(district["X"]), np.array(district["W"])
+            districts[district_name] = district
+    # longest-processing-time first: the bootstraps grow with the number of ballot boxes
+    order = sorted(districts, key=lambda name: len(districts[name]["X"]), reverse=True)
+
+    progress = tqdm(total=len(order), desc="Searching group aggregations", disable=not load_bar)
+    if jobs == 1:
+        for district_name in order:
+            save_district(search_district(district_name, districts[district_name], options)[1],
+                          output_folder, district_name)
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(search_district, name, districts[name], options) for name in order]
+            for future in as_completed(futures):
+                district_name, result = future.result()
+                save_district(result, output_folder, district_name)
+                progress.update()
+    progress.close()
+    return order
+
+
+# main
+if __name__ == "__main__":
+    start = time.perf_counter()
+    districts = search_all_districts(load_bar=True)
+    print(f"{len(districts)} districts saved to {OUTPUT_FOLDER} in {time.perf_counter() - start:.0f} s")
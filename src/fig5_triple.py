@@ -13,20 +13,20 @@ verbose = True # print outputs
 FOLDER = os.path.join("output", "results_districts")
 
 # Function that gets all group aggregations for all electoral districts
-# Reads from the .JSON output files generated in R
-def get_all_group_aggregations():
+# Reads from the .JSON output files generated in R (fig5_data.R) or Python (fig5_data.py)
+def get_all_group_aggregations(folder=FOLDER):
     # get all folder names in the output directory
     all_group_aggregations = []
     mesas = []
     # iterate over all .json files of the directory
-    for file in os.listdir(FOLDER):
+    for file in os.listdir(folder):
         # check if file is a .json file
         if not file.endswith('.json'):
             continue
         # read the json file
         district_name = file.split('.')[0]  # remove the .json extension
         # print(f"district_name = {district_name}")
-        data = read_district(district_name, folder=FOLDER)
+        data = read_district(district_name, folder=folder, keys=['group_agg', 'ballotbox_id'])
         # get the group aggregations
         group_agg = None
         if 'group_agg' in data:
@@ -35,8 +35,12 @@ def get_all_group_aggregations():
         else:
             group_agg = ['18+']
         all_group_aggregations.append(group_agg)
-        # get the number of mesas
-        mesas.append(len(data['X']))
+        # get the number of mesas from the ballot box ids (a scalar for a single ballot box),
+        # so the votes are never parsed; files without ids fall back to the rows of X
+        if 'ballotbox_id' in data:
+            mesas.append(len(data['ballotbox_id']) if isinstance(data['ballotbox_id'], list) else 1)
+        else:
+            mesas.append(len(read_district(district_name, folder=folder, keys=['X'])['X']))
     return all_group_aggregations, mesas
 
 # Function that creates a three-part figure:
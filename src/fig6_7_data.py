@@ -2,7 +2,6 @@
 # coding: utf-8
 
 import os
-import json
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -10,6 +9,8 @@ import seaborn as sns
 from pathlib import Path
 import matplotlib.gridspec as gridspec
 
+from aux_functions import read_district, get_district_arrays
+
 # Fixed candidate list for 2021 Chilean presidential election
 CANDIDATOS = np.array([
     "GABRIEL BORIC",
@@ -60,13 +61,12 @@ def compute_avg_ages(output_folder,
 
     data = []
     for dist_path in dist_files:
-        with open(dist_path, 'r') as file:
-            dist = json.load(file)
+        dist = read_district(dist_path.stem, folder=dist_path.parent, keys=['group_agg'])
+        arrays = get_district_arrays(dist_path.stem, dist_path.parent, keys=['X', 'W', 'prob'])
 
-        X = np.array(dist['X'])
-        W = np.array(dist['W'])
-        W_agg = np.array(dist['W_agg'])
-        prob = np.array(dist['prob'])
+        X = arrays['X']
+        W = arrays['W']
+        prob = arrays['prob']
         group_agg = dist.get('group_agg', [])
         if isinstance(group_agg, int):
             group_agg = [group_agg]
@@ -3,7 +3,7 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib import colors
-from aux_functions import read_district, load_pvalue_df, group_agg_to_macro_group
+from aux_functions import read_district, get_district_arrays, load_pvalue_df, group_agg_to_macro_group
 
 CANDIDATE_LABELS = [
     "G.B",
@@ -41,9 +41,11 @@ def plot_district_heatmap(df_pais, image_dir, max_pval=8, seed=42):
         if circ != "PUDAHUEL":
             continue
         try:
-            district_result = read_district(district_name = circ, folder=FOLDER_DISTRICT_RESULTS)
+            district_result = read_district(district_name = circ, folder=FOLDER_DISTRICT_RESULTS, keys=["group_agg", "p_values"])
+            arrays = get_district_arrays(circ, FOLDER_DISTRICT_RESULTS, keys=["X", "W_agg", "prob"])
+            matrizX, matrizW, prob = arrays["X"], arrays["W_agg"], arrays["prob"]
 
-            C = np.array(district_result["X"]).shape[1]
+            C = matrizX.shape[1]
             
             map_dif = sns.diverging_palette(
                 -50, 130, s=100, l=75, sep=25, center="light", as_cmap=True
@@ -51,19 +53,14 @@ def plot_district_heatmap(df_pais, image_dir, max_pval=8, seed=42):
             
             df_circ = df_pais[df_pais[COLUMN_DISTRICT] == circ].copy()
 
-            matrizX = np.array(district_result["X"])
             for i in range(C):
                 df_circ[CANDIDATE_LABELS[i]] = matrizX[:, i]
 
-            expected_votes = np.einsum(
-                "bg,gc->bc",
-                np.array(district_result["W_agg"]),
-                np.array(district_result["prob"]),
-            )
+            expected_votes = np.einsum("bg,gc->bc", matrizW, prob)
             expected_votes = (
                 expected_votes
-                * np.array(district_result["X"]).sum(axis=1, keepdims=True)
-                / np.array(district_result["W_agg"]).sum(axis=1, keepdims=True)
+                * matrizX.sum(axis=1, keepdims=True)
+                / matrizW.sum(axis=1, keepdims=True)
             )
 
             for i, c in enumerate(CANDIDATE_LABELS):
@@ -73,7 +70,7 @@ def plot_district_heatmap(df_pais, image_dir, max_pval=8, seed=42):
             groups = group_agg_to_macro_group(district_result["group_agg"])
             
             for i, g in enumerate(groups):
-                df_circ[g] = np.array(district_result["W_agg"])[:, i]
+                df_circ[g] = matrizW[:, i]
             
             df_circ[COLUMN_PVALUE] = district_result["p_values"]
 
@@ -5,14 +5,23 @@
 # it reas the .json files from results_district, computes the p-values
 # for each ballot box and saves the results in a new .json file in results_pvalues
 
+import hashlib
 import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 from tqdm import tqdm
-from p_val_mult import compute_thresholds, compute_p_value_m_mult_threshold
+from p_val_mult import (compute_thresholds, compute_p_value_m_mult_threshold,
+                        compute_p_value_importance, ballot_rng)
 from aux_functions import read_district
 
 FOLDER = os.path.join('output', 'results_districts')
+# per-shard progress of unfinished districts, so an interrupted run can resume
+CHECKPOINT_FOLDER = os.path.join('output', 'checkpoints', 'pvalues')
+# memory budget (bytes) for the samples being scored at once; a ballot box reaching S = 8 would
+# otherwise draw 10^8 samples in one array. compute_all_district_pvalues splits it among the workers
+MAX_MEMORY = 2**30
 
 # function that computes the voting probabilties of a district
 def compute_voting_probabilities(district_results):
@@ -23,9 +32,84 @@ def compute_voting_probabilities(district_results):
     print(f"B = {probabilities.shape[0]}")
     return probabilities
 
+# function that returns the ballot box ids of a district (their row index if missing)
+def get_ballot_ids(district_result):
+    ballot_ids = district_result.get('ballotbox_id', list(range(len(district_result['X']))))
+    # a district with a single ballot box stores its id as a scalar
+    if not isinstance(ballot_ids, list):
+        ballot_ids = [ballot_ids]
+    return ballot_ids
+
+# function that computes the p-values of a set of ballot boxes
+# every ballot box draws from its own random stream, keyed by (seed, district_name, ballot id),
+# so the p-values do not depend on the order, the shard or the worker that computes them
+def compute_ballot_pvalues(X, probabilities, S_min, S_max, thresholds, lgac_n, seed=None,
+                           ballot_ids = None, cumulative = False, max_memory = MAX_MEMORY,
+                           method = 'threshold', verbose = False, district_name = ''):
+    B, _ = X.shape
+    if ballot_ids is None:
+        ballot_ids = list(range(B))
+    rngs = [ballot_rng(seed, district_name, ballot_id) for ballot_id in ballot_ids]
+    p_values_trials = None
+    p_values_se = None
+    if method == 'importance':
+        # importance sampling: resolves very small p-values and reports their standard error
+        p_values = []
+        p_values_se = []
+        if verbose:
+            print(f"{'Disctrict':20.30s}\tp-value\tstd. error")
+        for b in range(B):
+            x = X[b, :]
+            r = probabilities[b, :]
+            log_p = np.where(r > 0, np.log(r), 0)
+            pval, se = compute_p_value_importance(x, r, log_p = log_p, lgac_n = lgac_n, rng = rngs[b])
+            p_values.append(float(pval))
+            p_values_se.append(float(se))
+            if verbose:
+                print(f'{district_name:20.30s}\t{pval}\t{se}')
+    else:
+        p_values = []
+        p_values_trials = []
+        if verbose:
+            print(f"{'Disctrict':20.30s}\tp-value\ttrials")
+        for b in range(B):
+            x = X[b, :]
+            r = probabilities[b, :]
+            log_p = np.where(r > 0, np.log(r), 0)
+            pval, trials = compute_p_value_m_mult_threshold(x, r, S_min, S_max, thresholds, log_p = log_p, lgac_n = lgac_n, rng = rngs[b],
+                                                            cumulative = cumulative, max_memory = max_memory)
+            p_values.append(pval)
+            p_values_trials.append(trials)
+            if verbose:
+                print(f'{district_name:20.30s}\t{pval}\t{trials}')
+    return p_values, p_values_trials, p_values_se
+
+# function that adds the p-values to a district result and saves it
+def save_district_pvalues(district_name, district_result, p_values, p_values_trials = None, p_values_se = None,
+                          save_json = True, inputs_hash = None):
+    # add the pvalues to the district result (trials for the threshold rule, std. errors for importance sampling)
+    district_result['p_values'] = p_values
+    if inputs_hash is not None:
+        district_result['p_values_hash'] = inputs_hash
+    for key, values in (('p_values_trials', p_values_trials), ('p_values_se', p_values_se)):
+        if values is None:
+            district_result.pop(key, None)
+        else:
+            district_result[key] = values
+
+    # save the .json
+    if save_json:
+        # save the results in a json file
+        # write and rename: the file is also the input of later runs, so a killed run must never truncate it
+        results_file = os.path.join(FOLDER, f'{district_name}.json')
+        with open(results_file + '.tmp', 'w') as f:
+            json.dump(district_result, f, ensure_ascii=False, indent=4)
+        os.replace(results_file + '.tmp', results_file)
+
 # function that analyze the ballot boxes of a district
 def analyze_ballot_boxes(district_name, S_min=3, S_max=5, thresholds=None, lgac_n=None, 
-                         seed=None, save_json=True, verbose = False):
+                         seed=None, save_json=True, verbose = False,
+                         cumulative = False, max_memory = MAX_MEMORY, method = 'threshold'):
 
     # Set default thresholds if not provided
     if thresholds is None:
@@ -34,47 +118,112 @@ def analyze_ballot_boxes(district_name, S_min=3, S_max=5, thresholds=None, lgac_
         thresholds = compute_thresholds(S_min, S_max, mu_power, alpha_power)
     # Set default lgac_n if not provided
     if lgac_n is None:
-        lgac_n = np.array([sum([np.log(max(k, 1)) for k in range(j + 1)]) for j in range(1000 + 1)])
-    # Set default seed if not provided
-    if seed is not None:
-        np.random.seed(42)  # Set seed for reproducibility in the main function
-    
+        lgac_n = compute_lgac_n()
+
     # read the district results
     district_result = read_district(district_name, folder=FOLDER)
     # compute the voting probabilities
     probabilities = compute_voting_probabilities(district_result)
     X = np.array(district_result['X'])
-    B, _ = X.shape
 
     # compute p-values
-    p_values = []
-    p_values_trials = []
-    current_seed = seed
-    if verbose:
-        print(f"{'Disctrict':20.30s}\tp-value\ttrials")
-    for b in range(B):
-        x = X[b, :]
-        r = probabilities[b, :]
-        log_p = np.where(r > 0, np.log(r), 0)
-        current_seed += 1
-        pval, trials = compute_p_value_m_mult_threshold(x, r, S_min, S_max, thresholds, log_p = log_p, lgac_n = lgac_n, seed = current_seed)
-        p_values.append(pval)
-        p_values_trials.append(trials)
-        if verbose:
-            print(f'{district_name:20.30s}\t{pval}\t{trials}')
-    # add the pvalues to the district result
-    district_result['p_values'] = p_values
-    district_result['p_values_trials'] = p_values_trials
+    p_values, p_values_trials, p_values_se = compute_ballot_pvalues(
+        X, probabilities, S_min, S_max, thresholds, lgac_n, seed = seed, ballot_ids = get_ballot_ids(district_result),
+        cumulative = cumulative, max_memory = max_memory, method = method, verbose = verbose,
+        district_name = district_name)
+    save_district_pvalues(district_name, district_result, p_values, p_values_trials, p_values_se,
+                          save_json = save_json)
+
+# function that recomputes the p-value of a single ballot box of a district
+# it reuses the ballot box random stream, so it matches the value of a full district run with the same seed
+def analyze_ballot_box(district_name, ballot_id, S_min=3, S_max=8, thresholds=None, lgac_n=None, seed=None,
+                       cumulative = False, max_memory = MAX_MEMORY, method = 'threshold'):
+    if thresholds is None:
+        thresholds = compute_thresholds(S_min, S_max, 5, 7)
+    if lgac_n is None:
+        lgac_n = compute_lgac_n()
+    district_result = read_district(district_name, folder=FOLDER)
+    b = get_ballot_ids(district_result).index(ballot_id)
+    probabilities = compute_voting_probabilities(district_result)[b:b + 1]
+    X = np.array(district_result['X'])[b:b + 1]
+    p_values, p_values_trials, p_values_se = compute_ballot_pvalues(
+        X, probabilities, S_min, S_max, thresholds, lgac_n, seed = seed, ballot_ids = [ballot_id],
+        cumulative = cumulative, max_memory = max_memory, method = method, district_name = district_name)
+    return p_values[0], (p_values_trials or p_values_se)[0]
+
+# log-factorial table lgac_n[j] = log(j!) for up to max_votes votes per ballot box
+def compute_lgac_n(max_votes = 1000):
+    return np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, max_votes + 1)))])
+
+# estimated cost of computing the p-values of a set of ballot boxes: drawing a
+# multinomial sample costs about one step per candidate plus one per vote
+def pvalue_cost(X):
+    return X.shape[0] * X.shape[1] + X.sum()
+
+# state shared by the worker processes, set once per process by init_pvalue_worker
+WORKER_STATE = {}
+
+def init_pvalue_worker(thresholds, lgac_n, options):
+    WORKER_STATE['thresholds'] = thresholds
+    WORKER_STATE['lgac_n'] = lgac_n
+    WORKER_STATE['options'] = options
+
+# computes the p-values of one shard (a range of ballot boxes of a district)
+def compute_pvalue_shard(task):
+    district_name, first_ballot, ballot_ids, X, probabilities = task
+    options = WORKER_STATE['options']
+    result = compute_ballot_pvalues(X, probabilities, options['S_min'], options['S_max'],
+                                    WORKER_STATE['thresholds'], WORKER_STATE['lgac_n'],
+                                    ballot_ids = ballot_ids, district_name = district_name,
+                                    **{k: v for k, v in options.items() if k not in ('S_min', 'S_max')})
+    return district_name, first_ballot, result
+
+# hash of everything that determines the p-values of a district: its data, the seed,
+# the thresholds and the options that change the result
+def pvalue_inputs_hash(district_result, seed, thresholds, options):
+    digest = hashlib.sha256()
+    for key in ('X', 'W_agg', 'prob'):
+        digest.update(np.asarray(district_result[key], dtype=float).tobytes())
+    settings = {'seed': seed, 'thresholds': {str(k): v for k, v in thresholds.items()},
+                'ballot_ids': get_ballot_ids(district_result),
+                **{k: options[k] for k in ('S_min', 'S_max', 'cumulative', 'method')}}
+    digest.update(json.dumps(settings, sort_keys = True, default = str).encode('utf-8'))
+    return digest.hexdigest()
+
+# reads the completed shards of a district whose checkpoint matches inputs_hash
+def load_checkpoint_shards(district_name, inputs_hash):
+    shards = {}
+    folder = os.path.join(CHECKPOINT_FOLDER, district_name)
+    if not os.path.isdir(folder):
+        return shards
+    for file in os.listdir(folder):
+        if not file.endswith('.json'):
+            continue
+        with open(os.path.join(folder, file), 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['hash'] == inputs_hash:
+            shards[(checkpoint['start'], checkpoint['stop'])] = checkpoint['result']
+    return shards
+
+# stores a completed shard of a district
+def save_checkpoint_shard(district_name, inputs_hash, start, stop, result):
+    folder = os.path.join(CHECKPOINT_FOLDER, district_name)
+    os.makedirs(folder, exist_ok = True)
+    checkpoint_file = os.path.join(folder, f'{start}_{stop}.json')
+    # write and rename, so a killed run never leaves a truncated checkpoint
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump({'hash': inputs_hash, 'start': start, 'stop': stop, 'result': result}, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
 
-    # save the .json
-    if save_json:
-        # save the results in a json file
-        results_file = os.path.join(FOLDER, f'{district_name}.json')
-        with open(results_file, 'w') as f:
-            json.dump(district_result, f, ensure_ascii=False, indent=4)
-    
 # function that computes the p-values for all district
-def compute_all_district_pvalues(load_bar = False, seed = None, save_json = False):
+# the districts are split in shards of at most shard_size ballot boxes and processed by `jobs`
+# worker processes, largest shards first, so a huge district does not finish alone at the end
+# with resume (and save_json), districts whose saved p-values come from the same inputs are
+# skipped and finished shards of the other districts are checkpointed and reused after a restart
+# max_memory is the budget of each worker, MAX_MEMORY shared among the `jobs` workers by default
+def compute_all_district_pvalues(load_bar = False, seed = None, save_json = False,
+                                 cumulative = False, max_memory = None, method = 'threshold',
+                                 jobs = 1, shard_size = 200, resume = True):
 
     # Calculate thresholds only once and pass them to inner functions
     S_min = 3
@@ -82,17 +231,76 @@ def compute_all_district_pvalues(load_bar = False, seed = None, save_json = Fals
     mu_power = 5
     alpha_power = 7
     thresholds = compute_thresholds(S_min, S_max, mu_power, alpha_power)
-    lgac_n = np.array([sum([np.log(max(k, 1)) for k in range(j + 1)]) for j in range(1000 + 1)])
-        
-    # iterate over all districts in the districts result folder
+    lgac_n = compute_lgac_n()
+    if max_memory is None:
+        max_memory = MAX_MEMORY // (jobs or os.cpu_count() or 1)
+    options = dict(S_min = S_min, S_max = S_max, seed = seed, cumulative = cumulative,
+                   max_memory = max_memory, method = method)
+
+    # split all districts in the districts result folder into shards
     districts_name = [f.split('.')[0] for f in os.listdir(FOLDER) if f.endswith('.json')]
-    for district_name in tqdm(districts_name, 'Processing district p-values', disable = not load_bar):
-        print(f"Processing district: {district_name}")
-        analyze_ballot_boxes(district_name, S_min = S_min, S_max = S_max, thresholds = thresholds, lgac_n = lgac_n, 
-                             seed = seed, save_json = save_json, verbose = False)
+    checkpoint = resume and save_json
+    tasks = []
+    n_shards = {}
+    shards = {}
+    inputs_hashes = {}
+    for district_name in districts_name:
+        district_result = read_district(district_name, folder=FOLDER)
+        inputs_hash = pvalue_inputs_hash(district_result, seed, thresholds, options)
+        if checkpoint and district_result.get('p_values_hash') == inputs_hash:
+            continue  # already computed with the same inputs
+        inputs_hashes[district_name] = inputs_hash
+        done = load_checkpoint_shards(district_name, inputs_hash) if checkpoint else {}
+        probabilities = compute_voting_probabilities(district_result)
+        X = np.array(district_result['X'])
+        ballot_ids = get_ballot_ids(district_result)
+        starts = range(0, X.shape[0], shard_size)
+        n_shards[district_name] = len(starts)
+        for start in starts:
+            stop = min(start + shard_size, X.shape[0])
+            if (start, stop) in done:
+                shards.setdefault(district_name, {})[start] = done[(start, stop)]
+                continue
+            tasks.append((district_name, start, ballot_ids[start:stop], X[start:stop], probabilities[start:stop]))
+    # longest-processing-time first
+    tasks.sort(key = lambda task: pvalue_cost(task[3]), reverse = True)
+
+    # gather the shards and save each district as soon as it is complete
+    def collect(district_name, first_ballot, result, stop = None):
+        shards.setdefault(district_name, {})[first_ballot] = result
+        if checkpoint and stop is not None:
+            save_checkpoint_shard(district_name, inputs_hashes[district_name], first_ballot, stop, result)
+        if len(shards[district_name]) < n_shards[district_name]:
+            return
+        parts = [part for _, part in sorted(shards.pop(district_name).items())]
+        # concatenate p-values, trials and std. errors of the shards in ballot order
+        merged = [None if parts[0][k] is None else sum((part[k] for part in parts), []) for k in range(3)]
+        save_district_pvalues(district_name, read_district(district_name, folder=FOLDER), *merged,
+                              save_json = save_json, inputs_hash = inputs_hashes[district_name])
+        if checkpoint:
+            shutil.rmtree(os.path.join(CHECKPOINT_FOLDER, district_name), ignore_errors = True)
+
+    # districts fully restored from their checkpoints
+    for district_name in [d for d in shards if len(shards[d]) == n_shards[d]]:
+        collect(district_name, *next(iter(shards[district_name].items())))
+
+    progress = tqdm(total = len(tasks), desc = 'Processing district p-values', disable = not load_bar)
+    if jobs == 1:
+        init_pvalue_worker(thresholds, lgac_n, options)
+        for task in tasks:
+            collect(*compute_pvalue_shard(task), stop = task[1] + len(task[3]))
+            progress.update()
+    else:
+        with ProcessPoolExecutor(max_workers = jobs, initializer = init_pvalue_worker,
+                                 initargs = (thresholds, lgac_n, options)) as executor:
+            futures = {executor.submit(compute_pvalue_shard, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                collect(*future.result(), stop = task[1] + len(task[3]))
+                progress.update()
+    progress.close()
 
     
 # main
 if __name__ == "__main__":
     compute_all_district_pvalues(load_bar = True, seed = 42, save_json = True)
-    
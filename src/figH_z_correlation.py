@@ -1,45 +1,166 @@
 import pickle
 import numpy as np
-import pandas as pd
+import pyarrow.parquet as pq
 import matplotlib.pyplot as plt
 import itertools
+from scipy.fft import next_fast_len
 
-def load_data(G_list, C_list, B, I, step_size, samples, seed_list, output_folder):
-    """Loads data from pickle files for all combinations of G and I."""
+def iter_chains(G, C, B, samples, seed_list, output_folder, ballots=None, entries=None, sample_index=None,
+                chain_block=8):
+    """
+    Streams the Z chains of configuration (G, C) from the parquet files of every seed.
+    Each file holds the counts of B ballots x samples x G*C entries in a single column; it is read
+    one row group at a time and kept as uint16, so only a row group and the current block of chains
+    are in memory. Row groups without requested ballots are not read.
+    ballots (indices in 0..B-1, read in increasing order), entries (indices in 0..G*C-1) and
+    sample_index (slice or indices of the samples) select a subset; None keeps all.
+    Yields uint16 arrays of up to chain_block chains, of shape (chains, samples, entries).
+    """
+    E = G * C
+    length = samples * E  # rows of a ballot
+    wanted = np.arange(B) if ballots is None else np.unique(ballots)
+    block = []
+    for s in seed_list:
+        parquet = pq.ParquetFile(f'{output_folder}/C{C}_G{G}/C{C}G{G}seed{s}.parquet')
+        buffer, buffer_start, start, next_wanted = np.empty(0, dtype=np.uint16), 0, 0, 0
+        for i in range(parquet.num_row_groups):
+            if next_wanted == len(wanted):
+                break
+            end = start + parquet.metadata.row_group(i).num_rows
+            if end <= wanted[next_wanted] * length:
+                start = end
+                continue  # row group before the next requested ballot
+            values = parquet.read_row_group(i).column(0).to_numpy()
+            if values.max() > np.iinfo(np.uint16).max:
+                raise ValueError(f'Z counts of seed {s} do not fit in uint16.')
+            values = values.astype(np.uint16)
+            if buffer.size == 0:
+                buffer, buffer_start = values, start
+            else:
+                buffer = np.concatenate([buffer, values])
+            start = end
+
+            # complete requested ballots in the buffer
+            while next_wanted < len(wanted) and (wanted[next_wanted] + 1) * length <= buffer_start + buffer.size:
+                offset = wanted[next_wanted] * length - buffer_start
+                chain = buffer[offset:offset + length].reshape(samples, E)
+                if sample_index is not None:
+                    chain = chain[sample_index]
+                if entries is not None:
+                    chain = chain[:, entries]
+                block.append(chain)
+                next_wanted += 1
+                if len(block) == chain_block:
+                    yield np.stack(block)
+                    block = []
+            # drop the rows before the next requested ballot
+            if next_wanted < len(wanted):
+                drop = min(max(wanted[next_wanted] * length - buffer_start, 0), buffer.size)
+                buffer, buffer_start = buffer[drop:], buffer_start + drop
+    if block:
+        yield np.stack(block)
+
+
+def load_omegaset(path):
+    """
+    Memory-maps an Omega set written by the sampler with --format npy (uint16 array of shape
+    (B, S, G, C)) and returns its chains as a (B, S, G*C) view, without copying the file.
+    """
+    Z = np.load(path, mmap_mode='r')
+    return Z.reshape(Z.shape[0], Z.shape[1], -1)
+
+
+def load_data(G_list, C_list, B, I, step_size, samples, seed_list, output_folder, **subset):
+    """
+    Loads the Z chains of all combinations of G and C in memory, as uint16 arrays of shape
+    (chains, samples, entries). subset takes the ballots, entries and sample_index of iter_chains.
+    """
     Z_dict = {}
     for G in G_list:
         for C in C_list:
-            Z_dict[G, C] = []
-            for s in seed_list:
-                # Z_instances/C2G2v2/C2G2seed1.pkl
-                # with open(f"{output_folder}/C{C}G{G}v2/C{C}G{G}seed{s}.pkl", "rb") as f:
-                # # with open(f"Z_instances/Z_instance_G{G}_I{I}_M{M}_J{J}_step{step_size}_S{samples}_seed{s}_sequence.pickle", 'rb') as f:
-                #     data = np.array(pickle.load(f))
-                #     # Flatten the last two dimensions out of four dimensions
-                #     data = data[:,:,:,:]
-                #     data = data.reshape((data.shape[0], data.shape[1], data.shape[2] * data.shape[3]))
-
-                data = pd.read_parquet(f'{output_folder}/C{C}_G{G}/C{C}G{G}seed{s}.parquet', engine='pyarrow').values
-                data = data.reshape((B,samples,G*C))
-
-                Z_dict[G, C].extend(data)
-            Z_dict[G, C] = np.array(Z_dict[G, C])
+            # Z_instances/C2G2v2/C2G2seed1.pkl (older runs were saved as pickles)
+            Z_dict[G, C] = np.concatenate(list(iter_chains(G, C, B, samples, seed_list, output_folder, **subset)))
     return Z_dict
 
-def calculate_mean_correlation(Z_dict, G_list, C_list, S_lim):
-    """Calculates the mean correlation for each step size."""
+
+def lagged_correlations(Z, max_lag, c=5):
+    """
+    Computes, for chains Z of shape (chains, samples, entries), the Pearson correlation between
+    Z[:-k] and Z[k:] for every lag k = 1..max_lag (same as np.corrcoef lag by lag), and the
+    integrated autocorrelation time of every chain and entry, using Sokal's automatic window
+    (smallest W with W >= c * tau(W)).
+    All lags come from one FFT: the lagged cross sums sum_t Z[t] Z[t+k] are the circular
+    autocorrelation of the zero-padded chains, and the segment sums come from cumulative sums.
+    Entries with a constant segment get nan, as with np.corrcoef.
+    Returns the correlations (chains, max_lag, entries) and the times (chains, entries).
+    """
+    if np.issubdtype(Z.dtype, np.integer):
+        # integer counts: every sum is exact, the FFT cross sums are rounded back to integers
+        Z = Z.astype(np.int64)
+    else:
+        # correlations don't change with the mean, removing it avoids cancellation
+        Z = Z - Z.mean(axis=1, keepdims=True)
+    S = Z.shape[1]
+    n_fft = next_fast_len(2 * S - 1)
+    f = np.fft.rfft(Z, n=n_fft, axis=1)
+    cross = np.fft.irfft(f.real ** 2 + f.imag ** 2, n=n_fft, axis=1)[:, :S]
+    del f
+    if np.issubdtype(Z.dtype, np.integer):
+        cross = np.rint(cross).astype(np.int64)
+
+    zeros = np.zeros_like(Z[:, :1])
+    cum = np.concatenate([zeros, np.cumsum(Z, axis=1)], axis=1)
+    cum2 = np.concatenate([zeros, np.cumsum(Z * Z, axis=1)], axis=1)
+    total, total2 = cum[:, -1:], cum2[:, -1:]
+
+    # sums of the segments Z[:n] (a) and Z[k:] (b) for every lag k, with n = S - k
+    k = np.arange(S)
+    n = (S - k)[None, :, None]
+    sum_a, sum_b = cum[:, S - k], total - cum[:, k]
+    sum_aa, sum_bb = cum2[:, S - k], total2 - cum2[:, k]
+
+    lags = slice(1, max_lag + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        num = n[:, lags] * cross[:, lags] - sum_a[:, lags] * sum_b[:, lags]
+        var_a = n[:, lags] * sum_aa[:, lags] - sum_a[:, lags] ** 2
+        var_b = n[:, lags] * sum_bb[:, lags] - sum_b[:, lags] ** 2
+        corr = num / np.sqrt(var_a.astype(float) * var_b)
+
+        # autocovariance around the chain mean, sum_t (Z[t] - m)(Z[t+k] - m)
+        mean = total / S
+        acov = cross - mean * (sum_a + sum_b) + n * mean ** 2
+        rho = acov / acov[:, :1]
+    tau = 2 * np.cumsum(rho, axis=1) - 1
+    in_window = k[None, :, None] >= c * tau
+    window = np.where(in_window.any(axis=1), in_window.argmax(axis=1), S - 1)
+    iat = np.take_along_axis(tau, window[:, None, :], axis=1)[:, 0]
+    return corr, iat
+
+
+def calculate_mean_correlation(Z_dict, G_list, C_list, S_lim, chain_block=8):
+    """
+    Calculates the mean correlation for each step size, and the integrated autocorrelation
+    time (IAT) and effective sample size (ESS) of the chains of each configuration.
+    Z_dict holds, for each (G, C), an array of chains or an iterable of blocks of chains
+    (e.g. iter_chains); chains are processed chain_block at a time with lagged_correlations.
+    """
     proms = {}
+    mixing = {}
     for G, C in itertools.product(G_list, C_list):
         print(f'Running G={G} C={C}')
         Z = Z_dict[G, C]
-        proms[G, C] = np.zeros((S_lim, Z.shape[0]))
-        for m, Z_s in enumerate(Z):
-            for s in range(S_lim):
-                proms[G, C][s, m] = np.mean([
-                    np.abs(np.corrcoef(Z_s[:-(s+1), i], Z_s[(s+1):, i])[0, 1]) for i in range(Z_s.shape[1])
-                ])
-        proms[G, C] = np.nanmean(proms[G, C], axis=1)
-    return proms
+        blocks = Z
+        if isinstance(Z, np.ndarray):
+            blocks = (Z[start:start + chain_block] for start in range(0, Z.shape[0], chain_block))
+        block_proms, iat = [], []
+        for block in blocks:
+            corr, block_iat = lagged_correlations(block, S_lim)
+            block_proms.append(np.abs(corr).mean(axis=2).T)
+            iat.append(block_iat)
+        proms[G, C] = np.nanmean(np.concatenate(block_proms, axis=1), axis=1)
+        iat = np.concatenate(iat)
+        mixing[G, C] = {'iat': np.nanmean(iat), 'ess': np.nanmean(block.shape[1] / iat)}
+    return proms, mixing
 
 def plot_results(proms, G_list, C_list, S_lim, step_size, img_path):
     """Plots the results of the mean correlations."""
@@ -85,13 +206,15 @@ def main():
     output_folder = 'output/figureH'
     img_path = 'figures/figH-z-correlation.pdf'
 
-    # Load the data
-    print('Loading Z instances')
-    Z_dict = load_data(G_list, C_list, B, I, step_size_value, samples, seed_list, output_folder)
+    # Stream the data (the chains of each configuration are read while computing its correlations)
+    Z_dict = {(G, C): iter_chains(G, C, B, samples, seed_list, output_folder)
+              for G, C in itertools.product(G_list, C_list)}
 
     # Calculate mean correlations
     print('Calculating correlations')
-    proms = calculate_mean_correlation(Z_dict, G_list, C_list, S_lim)
+    proms, mixing = calculate_mean_correlation(Z_dict, G_list, C_list, S_lim)
+    for (G, C), m in mixing.items():
+        print(f'G={G} C={C}: IAT = {m["iat"]:.2f} samples, ESS = {m["ess"]:.1f} of {samples}')
 
     # Plot the results
     plot_results(proms, G_list, C_list, S_lim, step_size, img_path)
@@ -1,5 +1,7 @@
 #include "cJSON.h"
 #include "globals.h"
+// uthash out-of-memory handler; its default calls error(), which is not declared here nor in every libc
+#define uthash_fatal(msg) do { fprintf(stderr, "%s\n", msg); exit(EXIT_FAILURE); } while (0)
 #include "uthash.h"
 #include "utils_matrix.h"
 #include <math.h>
@@ -13,10 +15,35 @@
 typedef struct
 {
     uint32_t b;
-    Matrix **data;
-    int *counts;
-    size_t size;
+    uint16_t *data; // Contiguous arena with every sample, sample `s` starts at data[s * G * C] (row-major: g * C + c)
+    int *counts;    // Repetitions of every sample when duplicates are collapsed (NULL otherwise)
+    size_t size;    // Number of samples stored
 } OmegaSet;
+
+// ---- Hash entry for finding repeated samples, the key is the sample stored in the arena ---- //
+typedef struct
+{
+    size_t index;      // Position of the sample in the arena
+    UT_hash_handle hh; // Makes this structure hashable
+} SampleEntry;
+
+// ---- Command line options ---- //
+typedef struct
+{
+    const char *inputPath;
+    const char *outputPath;
+    int S, M;
+    int dedup; // Collapse repeated samples into unique entries with counts
+    int npy;   // Write the OmegaSet as a .npy file instead of JSON
+    int seeded;    // Draw the random moves from per ballot streams of `seed` instead of the `rand()` tables
+    uint64_t seed; // Seed given with --seed
+} Options;
+
+// ---- State of a xoshiro256** random stream ---- //
+typedef struct
+{
+    uint64_t s[4];
+} RandomStream;
 // ---...--- //
 
 // ---- Macro for finding the minimum ---- //
@@ -63,7 +90,7 @@ void saveOmegaSetToJSON(const char *filename)
         // For each sample s in the OmegaSet
         for (size_t s = 0; s < set->size; s++)
         {
-            Matrix *mat = set->data[s];
+            const uint16_t *sample = set->data + s * TOTAL_GROUPS * TOTAL_CANDIDATES;
             // Create JSON array-of-arrays for this single matrix
             cJSON *mat_json = cJSON_CreateArray();
             if (!mat_json)
@@ -72,17 +99,16 @@ void saveOmegaSetToJSON(const char *filename)
             }
 
             // Fill rows
-            for (int g = 0; g < mat->rows; g++)
+            for (uint16_t g = 0; g < TOTAL_GROUPS; g++)
             {
                 cJSON *row_json = cJSON_CreateArray();
                 if (!row_json)
                 {
                     goto cleanup;
                 }
-                for (int c = 0; c < mat->cols; c++)
+                for (uint16_t c = 0; c < TOTAL_CANDIDATES; c++)
                 {
-                    double v = MATRIX_AT_PTR(mat, g, c);
-                    cJSON_AddItemToArray(row_json, cJSON_CreateNumber(v));
+                    cJSON_AddItemToArray(row_json, cJSON_CreateNumber(sample[g * TOTAL_CANDIDATES + c]));
                 }
                 cJSON_AddItemToArray(mat_json, row_json);
             }
@@ -98,6 +124,11 @@ void saveOmegaSetToJSON(const char *filename)
         }
         cJSON_AddNumberToObject(ballot_obj, "b", b);
         cJSON_AddItemToObject(ballot_obj, "matrices", matrices_array);
+        // Repetitions of every matrix, only when duplicates were collapsed
+        if (set->counts)
+        {
+            cJSON_AddItemToObject(ballot_obj, "counts", cJSON_CreateIntArray(set->counts, (int)set->size));
+        }
 
         // Append to root
         cJSON_AddItemToArray(root, ballot_obj);
@@ -125,6 +156,97 @@ cleanup:
     printf("OmegaSet saved to JSON %s\n", filename);
 }
 
+// Frees the samples of every ballot box
+void freeOmegaSet(void)
+{
+    if (!OMEGASET)
+        return;
+    for (uint32_t b = 0; b < TOTAL_BALLOTS; b++)
+    {
+        if (!OMEGASET[b])
+            continue;
+        free(OMEGASET[b]->data);
+        free(OMEGASET[b]->counts);
+        free(OMEGASET[b]);
+    }
+    free(OMEGASET);
+    OMEGASET = NULL;
+}
+
+// Appends the sample `z` to the arena of `set`. When `index` is given (collapsing duplicates), a sample that is
+// already in the set only increases its count
+void storeSample(OmegaSet *set, SampleEntry **index, const Matrix *z)
+{
+    size_t sampleSize = (size_t)TOTAL_GROUPS * TOTAL_CANDIDATES;
+    uint16_t *slot = set->data + set->size * sampleSize;
+    for (uint16_t g = 0; g < TOTAL_GROUPS; g++)
+    {
+        for (uint16_t c = 0; c < TOTAL_CANDIDATES; c++)
+        {
+            slot[g * TOTAL_CANDIDATES + c] = (uint16_t)MATRIX_AT_PTR(z, g, c);
+        }
+    }
+
+    if (index)
+    {
+        SampleEntry *found = NULL;
+        HASH_FIND(hh, *index, slot, sampleSize * sizeof(uint16_t), found);
+        if (found)
+        { // The slot is reused by the next sample
+            set->counts[found->index]++;
+            return;
+        }
+        SampleEntry *entry = malloc(sizeof(SampleEntry));
+        if (!entry)
+        {
+            fprintf(stderr, "Memory allocation failed in storeSample.\n");
+            exit(EXIT_FAILURE);
+        }
+        entry->index = set->size;
+        set->counts[set->size] = 1;
+        HASH_ADD_KEYPTR(hh, *index, slot, sampleSize * sizeof(uint16_t), entry);
+    }
+    set->size++;
+}
+
+// Writes the OmegaSet as a .npy file holding a uint16 array of shape (B, S, G, C), so it can be memory-mapped
+// from Python with np.load(filename, mmap_mode="r"). Every ballot box must have the same number of samples
+void saveOmegaSetToNpy(const char *filename)
+{
+    FILE *f = fopen(filename, "wb");
+    if (!f)
+    {
+        fprintf(stderr, "Error opening %s for writing\n", filename);
+        return;
+    }
+    size_t S = TOTAL_BALLOTS > 0 ? OMEGASET[0]->size : 0;
+    size_t sampleSize = (size_t)TOTAL_GROUPS * TOTAL_CANDIDATES;
+
+    // ---- Header (format version 1.0): magic string, version, header length and the array description ---- //
+    uint16_t one = 1;
+    char header[256];
+    int len = snprintf(header, sizeof(header), "{'descr': '%cu2', 'fortran_order': False, 'shape': (%u, %zu, %u, %u), }",
+                       *(uint8_t *)&one ? '<' : '>', TOTAL_BALLOTS, S, TOTAL_GROUPS, TOTAL_CANDIDATES);
+    // Pad with spaces so the data starts at a multiple of 64 bytes, the header ends with a newline
+    int padding = (64 - (10 + len + 1) % 64) % 64;
+    memset(header + len, ' ', padding);
+    len += padding;
+    header[len++] = '\n';
+    uint8_t headerLength[2] = {(uint8_t)(len & 0xff), (uint8_t)(len >> 8)};
+    fwrite("\x93NUMPY\x01\x00", 1, 8, f);
+    fwrite(headerLength, 1, 2, f);
+    fwrite(header, 1, len, f);
+    // ---...--- //
+
+    // ---- Data: the arenas of the ballot boxes, one after the other ---- //
+    for (uint32_t b = 0; b < TOTAL_BALLOTS; b++)
+    {
+        fwrite(OMEGASET[b]->data, sizeof(uint16_t), S * sampleSize, f);
+    }
+    fclose(f);
+    printf("OmegaSet saved to NPY %s\n", filename);
+}
+
 int lessThanColRow(Matrix mat, int b, int g, int c, int candidateVotes, int groupVotes)
 {
     int groupSum = 0;
@@ -143,6 +265,109 @@ int lessThanColRow(Matrix mat, int b, int g, int c, int candidateVotes, int grou
     return MIN(slackC, slackG);
 }
 
+// ---- Seeded random streams ---- //
+// Every ballot box draws its moves on the fly from its own xoshiro256** stream: the seed is expanded with
+// splitmix64 and the stream of ballot `b` starts `b` jumps (2^128 draws each) after it, so streams never overlap
+// and the samples don't depend on the number of threads
+
+uint64_t splitmix64(uint64_t *x)
+{
+    uint64_t z = (*x += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+static inline uint64_t rotl(const uint64_t x, int k)
+{
+    return (x << k) | (x >> (64 - k));
+}
+
+uint64_t nextRandom(RandomStream *rng)
+{
+    uint64_t *s = rng->s;
+    const uint64_t result = rotl(s[1] * 5, 7) * 9;
+    const uint64_t t = s[1] << 17;
+    s[2] ^= s[0];
+    s[3] ^= s[1];
+    s[1] ^= s[2];
+    s[0] ^= s[3];
+    s[2] ^= t;
+    s[3] = rotl(s[3], 45);
+    return result;
+}
+
+// Advances the stream 2^128 draws
+void jumpRandom(RandomStream *rng)
+{
+    static const uint64_t JUMP[] = {0x180ec6d33cfd0abaULL, 0xd5a61266f0c9392cULL, 0xa9582618e03fc9aaULL,
+                                    0x39abdc4529b1661cULL};
+    uint64_t s[4] = {0, 0, 0, 0};
+    for (int i = 0; i < 4; i++)
+    {
+        for (int bit = 0; bit < 64; bit++)
+        {
+            if (JUMP[i] & ((uint64_t)1 << bit))
+            {
+                for (int j = 0; j < 4; j++)
+                    s[j] ^= rng->s[j];
+            }
+            nextRandom(rng);
+        }
+    }
+    memcpy(rng->s, s, sizeof(s));
+}
+
+// Streams of the ballots 0, ..., B - 1, each one jump after the previous one (B - 1 jumps in total)
+RandomStream *ballotStreams(uint64_t seed, uint32_t B)
+{
+    RandomStream *streams = malloc(B * sizeof(RandomStream));
+    if (!streams)
+    {
+        fprintf(stderr, "Memory allocation failed in ballotStreams.\n");
+        exit(EXIT_FAILURE);
+    }
+    for (int i = 0; i < 4; i++)
+        streams[0].s[i] = splitmix64(&seed);
+    for (uint32_t b = 1; b < B; b++)
+    {
+        streams[b] = streams[b - 1];
+        jumpRandom(&streams[b]);
+    }
+    return streams;
+}
+
+// Uniform draw in [0, n) without modulo bias (Lemire's multiply and reject method)
+uint32_t boundedRandom(RandomStream *rng, uint32_t n)
+{
+    uint64_t m = (uint64_t)(uint32_t)(nextRandom(rng) >> 32) * n;
+    uint32_t low = (uint32_t)m;
+    if (low < n)
+    {
+        uint32_t threshold = -n % n;
+        while (low < threshold)
+        {
+            m = (uint64_t)(uint32_t)(nextRandom(rng) >> 32) * n;
+            low = (uint32_t)m;
+        }
+    }
+    return (uint32_t)(m >> 32);
+}
+
+// Draws the candidates and groups of a move, with the same rules as allocateRandoms
+void drawMove(RandomStream *rng, uint8_t *c1, uint8_t *c2, uint8_t *g1, uint8_t *g2)
+{
+    int allow_repeat = (TOTAL_CANDIDATES <= 1 || TOTAL_GROUPS <= 1);
+    *c1 = (uint8_t)boundedRandom(rng, TOTAL_CANDIDATES);
+    *g1 = (uint8_t)boundedRandom(rng, TOTAL_GROUPS);
+    do
+    {
+        *c2 = (uint8_t)boundedRandom(rng, TOTAL_CANDIDATES);
+        *g2 = (uint8_t)boundedRandom(rng, TOTAL_GROUPS);
+    } while (!allow_repeat && (*c2 == *c1 || *g2 == *g1));
+}
+// ---...--- //
+
 void allocateRandoms(int M, int S, uint8_t **c1, uint8_t **c2, uint8_t **g1, uint8_t **g2)
 {
     uint32_t size = M * S;
@@ -242,7 +467,8 @@ Matrix startingPoint3(int b)
     return toReturn;
 }
 
-void generateOmegaSet(int M, int S)
+// Without `seeded`, the moves come from tables pre-generated by allocateRandoms (seeded with the time)
+void generateOmegaSet(int M, int S, int dedup, int seeded, uint64_t seed)
 {
 #ifdef _OPENMP
 #pragma omp parallel
@@ -263,9 +489,13 @@ void generateOmegaSet(int M, int S)
     uint8_t *g1 = NULL;
     uint8_t *g2 = NULL;
 
-    uint32_t arraySize = M * S;
+    size_t sampleSize = (size_t)TOTAL_GROUPS * TOTAL_CANDIDATES;
 
-    allocateRandoms(M, S, &c1, &c2, &g1, &g2);
+    RandomStream *streams = NULL;
+    if (seeded)
+        streams = ballotStreams(seed, TOTAL_BALLOTS);
+    else
+        allocateRandoms(M, S, &c1, &c2, &g1, &g2);
     // Compute the partition size
     int partitionSize = M / TOTAL_BALLOTS;
     if (partitionSize == 0)
@@ -280,10 +510,19 @@ void generateOmegaSet(int M, int S)
         // ---- Define a seed, that will be unique per thread ----
         //    unsigned int seed = rand_r(&seedNum) + omp_get_thread_number();
         // ---- Allocate memory for the OmegaSet ---- //
+        // ---- Every sample goes to a single buffer, sized for the worst case of S different samples ---- //
         OMEGASET[b] = calloc(1, sizeof(OmegaSet));
         OMEGASET[b]->b = b;
-        OMEGASET[b]->size = S;
-        OMEGASET[b]->data = calloc(S, sizeof(Matrix *));
+        OMEGASET[b]->size = 0;
+        OMEGASET[b]->data = malloc(S * sampleSize * sizeof(uint16_t));
+        OMEGASET[b]->counts = dedup ? malloc(S * sizeof(int)) : NULL;
+        if (!OMEGASET[b]->data || (dedup && !OMEGASET[b]->counts))
+        {
+            fprintf(stderr, "Memory allocation failed in generateOmegaSet.\n");
+            exit(EXIT_FAILURE);
+        }
+        SampleEntry *index = NULL; // Samples already stored, only used when collapsing duplicates
+        SampleEntry **indexPtr = dedup ? &index : NULL;
         // ---...--- //
         // ---- The `base` element used as a starting point ----
         Matrix startingZ = startingPoint3(b);
@@ -299,27 +538,34 @@ void generateOmegaSet(int M, int S)
             }
         }
         int ballotShift = floor(((double)b / TOTAL_BALLOTS) * (M * S));
+        RandomStream rng;
+        if (seeded)
+            rng = streams[b];
 
         // Impose the first step
-        Matrix *append = calloc(1, sizeof(Matrix));
-        *append = copMatrix(&startingZ);
-        OMEGASET[b]->data[0] = append;
-        freeMatrix(&startingZ);
+        storeSample(OMEGASET[b], indexPtr, &startingZ);
 
+        // ---- Every sample continues the chain from the previous one ----
+        Matrix steppingZ = startingZ;
         for (int s = 1; s < S; s++)
         { // --- For each sample given a ballot box
             // TODO: El sampling debe hacerse de tamaño M*S
-            // ---- Copy the initial matrix ----
-            Matrix *pastMatrix = OMEGASET[b]->data[s - 1];
-            Matrix steppingZ = copMatrix(pastMatrix);
             for (int m = 0; m < M; m++)
             { // --- For each step size given a sample and a ballot box
                 // ---- Sample random indexes ---- //
-                int shiftIndex = (s * M + ballotShift + m) % (M * S);
-                uint8_t randomCDraw = c1[shiftIndex];
-                uint8_t randomCDraw2 = c2[shiftIndex];
-                uint8_t randomGDraw = g1[shiftIndex];
-                uint8_t randomGDraw2 = g2[shiftIndex];
+                uint8_t randomCDraw, randomCDraw2, randomGDraw, randomGDraw2;
+                if (seeded)
+                {
+                    drawMove(&rng, &randomCDraw, &randomCDraw2, &randomGDraw, &randomGDraw2);
+                }
+                else
+                {
+                    int shiftIndex = (s * M + ballotShift + m) % (M * S);
+                    randomCDraw = c1[shiftIndex];
+                    randomCDraw2 = c2[shiftIndex];
+                    randomGDraw = g1[shiftIndex];
+                    randomGDraw2 = g2[shiftIndex];
+                }
 
                 // decode(randomCDraw, TOTAL_CANDIDATES, &c1, &c2);
                 //  decode(randomGDraw, TOTAL_GROUPS, &g1, &g2);
@@ -340,14 +586,25 @@ void generateOmegaSet(int M, int S)
                 //  ---...--- //
             } // --- End the step size loop
             // ---- Add the combination to the OmegaSet ---- //
-            Matrix *append = calloc(1, sizeof(Matrix));
-            *append = copMatrix(&steppingZ);
-            OMEGASET[b]->data[s] = append;
-            freeMatrix(&steppingZ);
+            storeSample(OMEGASET[b], indexPtr, &steppingZ);
             // ---...--- //
         } // --- End the sample loop
-        // freeMatrix(&startingZ);
+        freeMatrix(&steppingZ);
+
+        // ---- Release the hash and shrink the buffers to the unique samples ---- //
+        if (dedup)
+        {
+            SampleEntry *entry, *tmp;
+            HASH_ITER(hh, index, entry, tmp)
+            {
+                HASH_DEL(index, entry);
+                free(entry);
+            }
+            OMEGASET[b]->data = realloc(OMEGASET[b]->data, OMEGASET[b]->size * sampleSize * sizeof(uint16_t));
+            OMEGASET[b]->counts = realloc(OMEGASET[b]->counts, OMEGASET[b]->size * sizeof(int));
+        }
     } // --- End the ballot box loop
+    free(streams);
     free(c1);
     free(c2);
     free(g1);
@@ -500,17 +757,88 @@ char *read_file(const char *filename)
     return content;
 }
 
+// Parses `path_to_json [output_json] S M [options]`, returns 0 if the arguments are invalid
+int parseOptions(int argc, char **argv, Options *options)
+{
+    const char *positional[4];
+    int nPositional = 0;
+    *options = (Options){.outputPath = NULL};
+
+    for (int i = 1; i < argc; i++)
+    {
+        if (strcmp(argv[i], "--dedup") == 0)
+        {
+            options->dedup = 1;
+        }
+        else if (strcmp(argv[i], "--seed") == 0 && i + 1 < argc)
+        {
+            char *end;
+            options->seed = strtoull(argv[++i], &end, 10);
+            options->seeded = 1;
+            if (*end != '\0')
+            {
+                fprintf(stderr, "Invalid seed %s\n", argv[i]);
+                return 0;
+            }
+        }
+        else if (strcmp(argv[i], "--format") == 0 && i + 1 < argc)
+        {
+            const char *format = argv[++i];
+            if (strcmp(format, "npy") == 0)
+                options->npy = 1;
+            else if (strcmp(format, "json") != 0)
+            {
+                fprintf(stderr, "Unknown format %s\n", format);
+                return 0;
+            }
+        }
+        else if (strncmp(argv[i], "--", 2) == 0)
+        {
+            fprintf(stderr, "Unknown option %s\n", argv[i]);
+            return 0;
+        }
+        else if (nPositional < 4)
+        {
+            positional[nPositional++] = argv[i];
+        }
+        else
+        {
+            return 0;
+        }
+    }
+    if (nPositional != 3 && nPositional != 4)
+        return 0;
+    if (options->npy && options->dedup)
+    {
+        fprintf(stderr, "--dedup can't be written as npy, ballot boxes would have different numbers of samples\n");
+        return 0;
+    }
+
+    options->inputPath = positional[0];
+    if (nPositional == 4)
+        options->outputPath = positional[1];
+    else
+        options->outputPath = options->npy ? "omegaset.npy" : "omegaset.json";
+    options->S = atoi(positional[nPositional - 2]); // samples
+    options->M = atoi(positional[nPositional - 1]); // steps
+    return 1;
+}
+
 int main(int argc, char **argv)
 {
-    if (argc != 4)
+    Options options;
+    if (!parseOptions(argc, argv, &options))
     {
-        fprintf(stderr, "Usage: %s path_to_json S M\n", argv[0]);
+        fprintf(stderr, "Usage: %s path_to_json [output_file] S M [--dedup] [--format json|npy] [--seed N]\n", argv[0]);
+        fprintf(stderr, "  --dedup         store every distinct sample once, with its number of repetitions\n");
+        fprintf(stderr, "  --format npy    write a uint16 .npy array of shape (B, S, G, C) instead of JSON\n");
+        fprintf(stderr, "  --seed N        reproducible run, every ballot box draws from its own stream of seed N\n");
         return 1;
     }
 
-    const char *json_path = argv[1];
-    int S = atoi(argv[2]); // samples
-    int M = atoi(argv[3]); // steps
+    const char *json_path = options.inputPath;
+    int S = options.S;
+    int M = options.M;
 
     if (S <= 0 || M <= 0)
     {
@@ -561,8 +889,12 @@ int main(int argc, char **argv)
     setParameters(&mx, &mw);
 
     // Generate the OmegaSet
-    generateOmegaSet(M, S);
-    saveOmegaSetToJSON("omegaset.json");
+    generateOmegaSet(M, S, options.dedup, options.seeded, options.seed);
+    if (options.npy)
+        saveOmegaSetToNpy(options.outputPath);
+    else
+        saveOmegaSetToJSON(options.outputPath);
+    freeOmegaSet();
 
     // Free temporary JSON-parsed matrix data
     free(X_data);
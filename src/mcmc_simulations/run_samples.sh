@@ -8,8 +8,8 @@ set -euo pipefail
 #        a) Run a fastei::simulate_elections() in R
 #        b) Save the raw election JSON to tempDir/data_<seed>.json
 #        c) Invoke the C program (readmat) to process that JSON into an OmegaSet
-#        d) Write the C-output JSON into ../../output/figureH/
-#           named as NUM_BALLOTS_NUM_CANDIDATES_NUM_GROUPS_seed.json
+#        d) Write the C-output (JSON, or .npy with FORMAT=npy) into ../../output/figureH/
+#           named as NUM_BALLOTS_NUM_CANDIDATES_NUM_GROUPS_seed.FORMAT
 # -------------------------------------------------------------------
 
 # 1) make a temp dir for the R outputs
@@ -24,6 +24,7 @@ NUM_GROUPS=2
 # 3) fixed C executable parameters
 S=100000    # number of MCMC samples
 M=100     # number of sampling steps
+FORMAT="json"  # output of the C program: json, or npy (uint16 array of shape (B, S, G, C))
 
 # 4) define where the C program should write its JSONs
 #    (two levels up from this script’s location → project_root/output/figureH)
@@ -50,15 +51,17 @@ for SEED in $(seq 1 20); do
   "
   echo "→ R election saved to: $IN_JSON"
 
-  # c) construct the output filename as NUM_BALLOTS_NUM_CANDIDATES_NUM_GROUPS_seed.json
-  OUT_JSON="${OUTPUT_DIR}/${NUM_BALLOTS}_${NUM_CANDIDATES}_${NUM_GROUPS}_${SEED}.json"
+  # c) construct the output filename as NUM_BALLOTS_NUM_CANDIDATES_NUM_GROUPS_seed.FORMAT
+  OUT_JSON="${OUTPUT_DIR}/${NUM_BALLOTS}_${NUM_CANDIDATES}_${NUM_GROUPS}_${SEED}.${FORMAT}"
 
   # d) call the C binary (readmat) with:
   #      1) the R-generated JSON
   #      2) the desired output path under output/figureH
   #      3) S (samples), M (steps)
-  readmat "$IN_JSON" "$OUT_JSON" "${S}" "${M}"
+  #      4) the output format
+  #      5) the seed of the random moves, so the run can be reproduced
+  readmat "$IN_JSON" "$OUT_JSON" "${S}" "${M}" --format "${FORMAT}" --seed "${SEED}"
   echo "→ C output saved to: $OUT_JSON"
 done
 
-echo "All done! Processed JSONs are in: $OUTPUT_DIR"
+echo "All done! Processed outputs are in: $OUTPUT_DIR"
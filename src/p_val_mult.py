@@ -1,6 +1,18 @@
+import hashlib
+import json
+import os
+from math import comb
 import numpy as np
 import scipy.stats as stats
+from scipy.special import gammaln, logsumexp
 
+# on-disk cache of the stopping thresholds, shared by every run and worker
+THRESHOLDS_CACHE = os.path.join("output", "cache", "p_val_thresholds.json")
+# ballot boxes with at most this many possible outcomes get an exact p-value;
+# enumerating them costs about as much as a 10^5-sample stage
+EXACT_MAX_OUTCOMES = 10**5
+# Dirichlet concentrations of the importance-sampling proposal, as fractions of J
+IS_DISPERSIONS = (1 / 2, 1 / 8, 1 / 32, 1 / 128)
 
 
 def p_val_threshold_n(n, mu, alpha):
@@ -8,16 +20,12 @@ def p_val_threshold_n(n, mu, alpha):
     Compute the smallest z such that P(X <= z - 1) >= 1 - alpha
     """
 
-    # n : number of trials
+    # n : number of trials (int or array)
     # mu : interested in p-values less than or equal to mu
     # alpha : significance level
-    # Returns the smallest z such that P(X <= z - 1) >= 1 - alpha
-    cum_prob = 0
-    for z in range(n + 1):
-        cum_prob += stats.binom.pmf(z - 1, n, mu)
-        if cum_prob >= 1 - alpha:
-            return z
-    return n  # In case the loop finishes without reaching threshold
+    # X ~ Binomial(n, mu), so z - 1 is the (1 - alpha)-quantile of X
+    z = stats.binom.ppf(1 - alpha, n, mu) + 1
+    return np.minimum(z, n).astype(int)  # n in case the threshold is never reached
 
 
 """
@@ -25,14 +33,103 @@ Obtener el threshold para la cantidad óptima de iteraciones
 """
 
 
-def compute_thresholds(S_min, S_max, mu_power, alpha_power):
-    thresholds = {}
-    mu = 10 ** (-mu_power)
-    alpha = 10 ** (-alpha_power)
-    for s in range(S_min, S_max + 1):
-        n = int(10**s)
-        thresholds[s] = p_val_threshold_n(n, mu, alpha)
-    return thresholds
+def compute_thresholds(S_min, S_max, mu_power, alpha_power, cache_file=THRESHOLDS_CACHE):
+    """
+    Stopping threshold for every stage s in [S_min, S_max] (10^s samples).
+
+    Thresholds are read from cache_file when present and the missing ones are
+    computed and added to it; cache_file=None disables the cache.
+    """
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+
+    stages = list(range(S_min, S_max + 1))
+    keys = {s: f"{s}_{mu_power}_{alpha_power}" for s in stages}
+    missing = [s for s in stages if keys[s] not in cache]
+    if missing:
+        mu = 10 ** (-mu_power)
+        alpha = 10 ** (-alpha_power)
+        n = np.array([int(10**s) for s in missing])
+        for s, z in zip(missing, p_val_threshold_n(n, mu, alpha)):
+            cache[keys[s]] = int(z)
+        if cache_file is not None:
+            os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+            # write and rename so concurrent workers never read a partial file
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(cache, f, indent=4, sort_keys=True)
+            os.replace(tmp_file, cache_file)
+
+    return {s: cache[keys[s]] for s in stages}
+
+
+"""
+Generadores aleatorios por mesa
+"""
+
+
+def ballot_rng(run_key, district_name, ballot_id):
+    """
+    Independent, addressable random stream for one ballot box.
+
+    The stream is a Philox generator keyed by (run_key, district_name, ballot_id),
+    so a ballot box gets the same draws whatever order, shard or worker it is
+    computed in, and can be recomputed on its own. run_key=None gives a fresh,
+    non-reproducible stream.
+    """
+    if run_key is None:
+        return np.random.Generator(np.random.Philox())
+    words = [int(run_key)] + [
+        int.from_bytes(hashlib.sha256(str(value).encode("utf-8")).digest()[:8], "little")
+        for value in (district_name, ballot_id)
+    ]
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence(words)))
+
+
+"""
+Cálculo exacto para mesas pequeñas
+"""
+
+
+def count_outcomes(J, C):
+    """Number of ways of distributing J votes among C candidates."""
+    return comb(int(J) + C - 1, C - 1)
+
+
+def compositions(J, C):
+    """All vectors of C non-negative integers adding up to J, one per row."""
+    dtype = np.min_scalar_type(J)
+    parts = np.zeros((1, 0), dtype=dtype)
+    remaining = np.array([J], dtype=np.int64)
+    for _ in range(C - 1):
+        # every partial vector is extended with each value between 0 and what is left
+        counts = remaining + 1
+        rows = np.repeat(np.arange(len(remaining)), counts)
+        value = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        parts = np.column_stack([parts[rows], value.astype(dtype)])
+        remaining = remaining[rows] - value
+    return np.column_stack([parts, remaining.astype(dtype)])
+
+
+def compute_p_value_exact(x, r, lgac_n=None, log_p=None):
+    """
+    Exact P(logPMF(X) <= logPMF(x)) for X ~ Multinomial(sum(x), r).
+
+    Every outcome over the candidates with r > 0 is enumerated and scored with the
+    same expression as the Monte Carlo samples, so ties are resolved identically.
+    Only practical when count_outcomes(sum(x), #{r > 0}) is small.
+    """
+    J = int(sum(x))
+    support = np.flatnonzero(r > 0)
+    outcomes = np.zeros((count_outcomes(J, len(support)), len(x)), dtype=np.min_scalar_type(J))
+    outcomes[:, support] = compositions(J, len(support))
+    beta_n = np.sum(x * log_p) - np.sum(lgac_n[x])
+    beta_S = np.sum(outcomes * log_p, axis=1) - np.sum(lgac_n[outcomes], axis=1)
+    # beta + log(J!) is the multinomial log-probability of each outcome
+    p_value = np.sum(np.exp(beta_S[beta_S <= beta_n] + lgac_n[J]))
+    return min(p_value, 1.0)
 
 
 """
@@ -40,21 +137,144 @@ Cálculo principal
 """
 
 
+def count_less_p(J, r, n, beta_n, lgac_n, log_p, chunk_size=None, rng=None):
+    """
+    Draw n multinomial samples of J votes and count those with log-likelihood <= beta_n.
+
+    With chunk_size the samples are drawn and scored chunk_size at a time and kept in
+    the smallest integer dtype that holds J. The random stream is consumed in the same
+    order, so the count is exactly the one obtained drawing all n samples at once.
+    Samples come from rng (a np.random.Generator) or, if None, the global NumPy state.
+    """
+    if rng is None:
+        rng = np.random
+    if chunk_size is None or chunk_size >= n:
+        x_samples = rng.multinomial(J, r, size=n)
+        beta_S = np.sum(x_samples * log_p, axis=1) - np.sum(lgac_n[x_samples], axis=1)
+        return np.sum(beta_S <= beta_n)
+    dtype = np.min_scalar_type(J)
+    less_p = 0
+    for start in range(0, n, chunk_size):
+        x_samples = rng.multinomial(J, r, size=min(chunk_size, n - start)).astype(dtype)
+        beta_S = np.sum(x_samples * log_p, axis=1) - np.sum(lgac_n[x_samples], axis=1)
+        less_p += np.sum(beta_S <= beta_n)
+    return less_p
+
+
+def chunk_size_for_memory(max_memory, C):
+    """
+    Number of samples of C candidates that can be scored within max_memory bytes.
+
+    A chunk holds the int64 draw (or its compact copy) plus two float64 temporaries
+    of the same shape while it is scored.
+    """
+    if max_memory is None:
+        return None
+    return max(1, int(max_memory) // (24 * C))
+
+
 def compute_p_value_m_mult_threshold(
-    x, r, S_min, S_max, thresholds, lgac_n=None, log_p=None, seed=None
+    x, r, S_min, S_max, thresholds, lgac_n=None, log_p=None, seed=None, cumulative=False,
+    max_memory=None, exact_max_outcomes=EXACT_MAX_OUTCOMES, rng=None,
 ):
-    if seed is not None:
+    """
+    Monte Carlo p-value of the ballot box x under a multinomial with probabilities r.
+
+    Stage s uses 10^s samples and stops once at least thresholds[s] of them are as
+    unlikely as x. With cumulative=True the samples of previous stages are kept and
+    only the 10^s - 10^(s-1) new ones are drawn, so a box reaching S_max costs 10^S_max
+    draws instead of 1.111 x 10^S_max. The count at stage s is still Binomial(10^s, p),
+    as in the fresh-sample rule, so the same thresholds apply.
+
+    With max_memory (bytes) the samples of a stage are drawn and scored in chunks that
+    fit the budget; the result is identical to the unchunked computation.
+
+    Ballot boxes with at most exact_max_outcomes possible outcomes are solved exactly
+    with compute_p_value_exact and returned with stage 0 (no sampling).
+
+    Samples come from rng (see ballot_rng) when given, otherwise from the global NumPy
+    state seeded with seed.
+    """
+    if count_outcomes(sum(x), np.sum(r > 0)) <= exact_max_outcomes:
+        return compute_p_value_exact(x, r, lgac_n=lgac_n, log_p=log_p), 0
+    if rng is None and seed is not None:
         np.random.seed(seed)
     J = sum(x)
     # log_p = np.log(r)
     # lgac_n = np.array([sum([np.log(max(k, 1)) for k in range(j + 1)]) for j in range(J + 1)])
     beta_n = np.sum(x * log_p) - np.sum(lgac_n[x])
+    chunk_size = chunk_size_for_memory(max_memory, len(x))
+    less_p = 0
+    n_prev = 0
     for s in range(S_min, S_max + 1):
         n = int(10**s)
         threshold = thresholds[s]
-        x_samples = np.random.multinomial(J, r, size=n)
-        beta_S = np.sum(x_samples * log_p, axis=1) - np.sum(lgac_n[x_samples], axis=1)
-        less_p = np.sum(beta_S <= beta_n)
+        if cumulative:
+            # reuse the previous draws, sample only the missing ones
+            less_p += count_less_p(J, r, n - n_prev, beta_n, lgac_n, log_p, chunk_size, rng)
+        else:
+            less_p = count_less_p(J, r, n, beta_n, lgac_n, log_p, chunk_size, rng)
+        n_prev = n
         if less_p >= threshold:
             break
     return less_p / n, s
+
+
+"""
+Cálculo por muestreo de importancia (p-valores extremos)
+"""
+
+
+def compute_p_value_importance(
+    x, r, n_samples=5 * 10**4, lgac_n=None, log_p=None, seed=None, concentrations=None,
+    exact_max_outcomes=EXACT_MAX_OUTCOMES, rng=None,
+):
+    """
+    Importance-sampling estimate of the p-value of x and its standard error.
+
+    Samples come from an equal-weight mixture of the multinomial itself and
+    Dirichlet-multinomials with mean r and concentrations A (by default J/2, J/8,
+    J/32, J/128): each component draws its probabilities from Dirichlet(A r), which
+    tilts the samples away from the mode in every direction, towards the
+    low-likelihood outcomes that make up the p-value. Samples are weighted by
+    Mult(X; r) / mixture(X), so the estimate is unbiased, and the weights are bounded
+    by the number of components since the multinomial is one of them. A few 10^4
+    draws resolve p-values down to about 1e-12 and below.
+
+    Returns:
+        (float, float): estimated p-value and its standard error. Ballot boxes
+        below exact_max_outcomes return the exact p-value with standard error 0.
+    """
+    if count_outcomes(sum(x), np.sum(r > 0)) <= exact_max_outcomes:
+        return compute_p_value_exact(x, r, lgac_n=lgac_n, log_p=log_p), 0.0
+    if rng is None:
+        rng = np.random.default_rng(seed)
+    J = int(sum(x))
+    beta_n = np.sum(x * log_p) - np.sum(lgac_n[x])
+    support = r > 0
+    r_support = r[support]
+    if concentrations is None:
+        concentrations = [J * f for f in IS_DISPERSIONS if J * f >= 0.5]
+    K = len(concentrations) + 1
+
+    # draw the probabilities of every sample from its mixture component
+    sizes = rng.multinomial(n_samples, np.full(K, 1 / K))
+    probs = [np.broadcast_to(r_support, (sizes[0], len(r_support)))]
+    probs += [rng.dirichlet(A * r_support, size=m) for A, m in zip(concentrations, sizes[1:])]
+    x_support = rng.multinomial(J, np.concatenate(probs))
+
+    # log-pmf of every component, up to the common term log(J!) - sum log(X_c!)
+    log_mult = x_support @ log_p[support]
+    log_components = [log_mult]
+    for A in concentrations:
+        alpha = A * r_support
+        log_components.append(
+            gammaln(A) - gammaln(J + A) + np.sum(gammaln(x_support + alpha) - gammaln(alpha), axis=1)
+        )
+    log_proposal = logsumexp(np.array(log_components), axis=0) - np.log(K)
+
+    x_samples = np.zeros((n_samples, len(x)), dtype=x_support.dtype)
+    x_samples[:, support] = x_support
+    beta_S = np.sum(x_samples * log_p, axis=1) - np.sum(lgac_n[x_samples], axis=1)
+    values = np.where(beta_S <= beta_n, np.exp(log_mult - log_proposal), 0)
+    return values.mean(), values.std(ddof=1) / np.sqrt(n_samples)
@@ -0,0 +1,218 @@
+# columnar store of district results
+
+# the per-district .json files (X, W, W_agg, prob, p-values, ...) of a results folder are packed
+# into a single Parquet file, <folder>.parquet, with one row per district:
+#   - array fields are stored flat in an Arrow list column (its offsets give the range of every
+#     district) plus a <key>__shape column, so ragged matrices of any size share one column
+#   - scalar fields (iterations, logLik, message, ...) get a plain column
+#   - every district is its own row group, so reading a district decodes only its rows
+#   - the schema metadata keeps the signature (mtime and size) of the .json files the store was
+#     built from, and the store is rebuilt when a file changes, as the packed array cache
+# read_district below returns the same dictionary as aux_functions.read_district
+
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aux_functions import files_signature
+
+COLUMN_DISTRICT = "district"
+SHAPE_SUFFIX = "__shape"
+SIGNATURE_KEY = b"signature"
+# stores opened in this process: path -> (signature, ParquetFile, {district: (row group, row)})
+STORES_OPENED = {}
+
+
+# path of the store of a results folder, e.g. output/results_districts.parquet
+def store_path(folder):
+    return os.path.normpath(folder) + ".parquet"
+
+
+# smallest Arrow integer type that holds all the values
+def compact_int_type(values):
+    if len(values) == 0:
+        return pa.int8()
+    low, high = int(np.min(values)), int(np.max(values))
+    for dtype, arrow_type in ((np.int8, pa.int8()), (np.int16, pa.int16()), (np.int32, pa.int32())):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return arrow_type
+    return pa.int64()
+
+
+# builds the flat values and shape columns of an array field
+def array_columns(values):
+    arrays = [None if v is None else np.asarray(v) for v in values]
+    present = [a for a in arrays if a is not None]
+    if all(a.dtype.kind in "USO" for a in present):
+        value_type = pa.string()
+        flat = [None if a is None else [str(v) for v in a.ravel()] for a in arrays]
+    else:
+        is_int = all(a.dtype.kind in "iub" or a.size == 0 for a in present)
+        flat = [None if a is None else a.ravel() for a in arrays]
+        if is_int:
+            value_type = compact_int_type(np.concatenate([a for a in flat if a is not None] or [[]]))
+        else:
+            value_type = pa.float64()
+    shapes = [None if a is None else list(a.shape) for a in arrays]
+    return pa.array(flat, type=pa.list_(value_type)), pa.array(shapes, type=pa.list_(pa.int32()))
+
+
+# signature of the .json files of a results folder
+def folder_signature(folder):
+    return files_signature([os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".json")])
+
+
+# signature of the .json files a store was built from (None for a store without one)
+def store_signature(path):
+    metadata = pq.read_schema(path).metadata or {}
+    return json.loads(metadata[SIGNATURE_KEY]) if SIGNATURE_KEY in metadata else None
+
+
+# converts all the .json files of a results folder into its Parquet store
+def convert_results_folder(folder, path=None):
+    if path is None:
+        path = store_path(folder)
+    # taken before reading, so a file changed during the conversion leaves the store outdated
+    signature = folder_signature(folder)
+    districts = sorted(f[: -len(".json")] for f in signature)
+    results = []
+    for district in districts:
+        with open(os.path.join(folder, f"{district}.json"), "r", encoding="utf-8") as f:
+            results.append(json.load(f))
+
+    keys = []
+    for result in results:
+        keys.extend(k for k in result if k not in keys)
+
+    columns = {COLUMN_DISTRICT: pa.array(districts, type=pa.string())}
+    for key in keys:
+        values = [result.get(key) for result in results]
+        if any(isinstance(v, list) for v in values):
+            # array field (a scalar in some districts is kept as a 0-d array)
+            columns[key], columns[key + SHAPE_SUFFIX] = array_columns(values)
+        else:
+            columns[key] = pa.array(values)
+
+    table = pa.table(columns).replace_schema_metadata({SIGNATURE_KEY: json.dumps(signature)})
+    # write and rename, so an interrupted conversion never leaves a truncated store
+    pq.write_table(table, path + ".tmp", row_group_size=1)
+    os.replace(path + ".tmp", path)
+    STORES_OPENED.pop(path, None)
+    return path
+
+
+# opens the store of a results folder, building it if it is missing or older than the .json files
+# a store whose results folder does not exist is used as it is
+def open_store(folder, rebuild=False):
+    path = store_path(folder)
+    signature = folder_signature(folder) if os.path.isdir(folder) else None
+    opened = STORES_OPENED.get(path)
+    if not rebuild and opened is not None and (signature is None or opened[0] == signature):
+        return opened
+
+    if rebuild or not os.path.exists(path) or (signature is not None and store_signature(path) != signature):
+        if signature is None:
+            raise FileNotFoundError(f"Results store not found at '{path}'.")
+        convert_results_folder(folder, path)
+    parquet = pq.ParquetFile(path)
+    starts = np.cumsum([0] + [parquet.metadata.row_group(g).num_rows for g in range(parquet.num_row_groups)])
+    districts = parquet.read(columns=[COLUMN_DISTRICT]).column(0).to_pylist()
+    index = {}
+    for row, district in enumerate(districts):
+        group = int(np.searchsorted(starts, row, side="right")) - 1
+        index[district] = (group, row - int(starts[group]))
+    STORES_OPENED[path] = (store_signature(path), parquet, index)
+    return STORES_OPENED[path]
+
+
+# rebuilds the nested lists of an array field from its flat values and shape
+def unflatten(values, shape):
+    if len(shape) == 0:
+        return values[0]
+    return np.asarray(values, dtype=object).reshape(shape).tolist() if values else np.empty(shape).tolist()
+
+
+def read_district(district_name, last_name="", folder="", keys=None):
+    """
+    Read the results of a district from the Parquet store of a results folder.
+
+    The store is opened once per process and rebuilt when the .json file of the district
+    changes (see open_store).
+
+    Parameters:
+        district_name (str): Name of the district.
+        last_name (str): Optional suffix of the district file name.
+        folder (str): Results folder whose store (see store_path) is read.
+        keys (list): Optional subset of fields to read.
+
+    Returns:
+        dict: Same content as the district .json file.
+
+    Raises:
+        FileNotFoundError: If the store or the district does not exist.
+    """
+    district = f"{district_name}{last_name}"
+    filename = f"{district}.json"
+    district_file = os.path.join(folder, filename)
+    opened = STORES_OPENED.get(store_path(folder))
+    # only the requested district is checked once the store is opened
+    if opened is None or (
+        os.path.exists(district_file) and opened[0].get(filename) != files_signature([district_file])[filename]
+    ):
+        opened = open_store(folder)
+    _, parquet, index = opened
+    if district not in index:
+        raise FileNotFoundError(f"District {district_name} not found in '{store_path(folder)}'.")
+    schema = parquet.schema_arrow
+    names = [name for name in schema.names if name != COLUMN_DISTRICT and not name.endswith(SHAPE_SUFFIX)]
+    if keys is not None:
+        names = [name for name in names if name in keys]
+    columns = [COLUMN_DISTRICT] + [
+        column for name in names for column in (name, name + SHAPE_SUFFIX) if column in schema.names
+    ]
+    group, position = index[district]
+    row = parquet.read_row_group(group, columns=columns).slice(position, 1).to_pylist()[0]
+    result = {}
+    for name in names:
+        value = row[name]
+        if value is None:
+            continue  # field missing in this district
+        shape = row.get(name + SHAPE_SUFFIX)
+        result[name] = value if name + SHAPE_SUFFIX not in row else unflatten(value, shape)
+    return result
+
+
+# flat values of an array field for every district, without building Python objects
+# returns (districts, values, offsets): the values of districts[i] are values[offsets[i]:offsets[i + 1]]
+# the store is checked against all the .json files of the folder first (see open_store)
+def read_store_arrays(folder, key):
+    _, parquet, _ = open_store(folder)
+    table = parquet.read(columns=[COLUMN_DISTRICT, key])
+    column = table.column(key).combine_chunks()
+    offsets = column.offsets.to_numpy()
+    values = column.values.to_numpy(zero_copy_only=False)
+    return table.column(COLUMN_DISTRICT).to_pylist(), values[offsets[0] :], offsets - offsets[0]
+
+
+# ballot-box ids and p-values of the districts with p-values, for aux_functions.load_pvalue_df
+# returns (districts, counts, ballots, p_values), the ids and p-values of all districts concatenated
+def read_store_pvalues(folder):
+    districts, p_values, p_offsets = read_store_arrays(folder, "p_values")
+    _, ballots, b_offsets = read_store_arrays(folder, "ballotbox_id")
+    counts, ballot_counts = np.diff(p_offsets), np.diff(b_offsets)
+    kept = counts > 0  # districts without p-values are left out
+    for district in np.flatnonzero(kept & (counts != ballot_counts)):
+        raise ValueError(
+            f"District {districts[district]} has {ballot_counts[district]} ballot boxes but {counts[district]} p-values."
+        )
+    ballots = ballots[np.repeat(kept, ballot_counts)]
+    return [d for d, k in zip(districts, kept) if k], counts[kept], ballots, p_values.astype(np.float64)
+
+
+# main: builds the stores of all results folders
+if __name__ == "__main__":
+    for folder in ("results_districts", "results_districts_age40", "results_districts_sex"):
+        folder = os.path.join("output", folder)
+        if os.path.isdir(folder):
+            print(f"Results store saved to {convert_results_folder(folder)}")
@@ -2,9 +2,10 @@ import numpy as np
 import pickle
 import matplotlib.pyplot as plt
 import os
-import json
 import pandas as pd
 
+from aux_functions import init_sensitivity
+
 results_folder = "output/simulated_instances" # where the instances are
 text_path = "tables/tableE" # where to save the table text (to copy as latex)
 
@@ -24,48 +25,10 @@ instances = []
 n_instances = len(I_list)*len(B_list)*len(G_list)*len(C_list)*len(seed_list)
 EM_method_names = ["exact"]
 
-df_differences = []
-
-# Custom Read Instances (pinit{s} indicates seed {s} for randomized initial matrix p)
-for I in I_list:
-    for M in B_list:
-        for G in G_list:
-            for C in C_list:
-                for lambda_ in lambda_list:
-                    for cv in cv_list:
-                        for seed1 in seed_list:
-                            for seed2 in seed_list[seed1:]:
-                                # results/I100_B50_G2_C3_lambda50/exact/1_pinit1.json
-                                json_path_1 = f'I{I}_B{M}_G{G}_C{C}_lambda{int(100*lambda_)}/exact/1_pinit{seed1}.json'
-                                file_path_1 = os.path.join(results_folder, json_path_1)
-                                if os.path.exists(file_path_1):
-                                    # read json
-                                    with open(file_path_1, 'r') as f:
-                                        instance1 = json.load(f)
-                                    p_est1 = np.array(instance1['prob'])
-
-                                else:
-                                    print("File not found:", file_path_1)
-                                # same for seed2
-                                json_path_2 = f'I{I}_B{M}_G{G}_C{C}_lambda{int(100*lambda_)}/exact/1_pinit{seed2}.json'
-                                file_path_2 = os.path.join(results_folder, json_path_2)
-                                if os.path.exists(file_path_2):
-                                    # read json
-                                    with open(file_path_2, 'r') as f:
-                                        instance2 = json.load(f)
-                                    # print(instance)
-                                    p_est2 = np.array(instance2['prob'])
-
-                                # frobenius norm
-                                dif_instance = np.mean(np.abs(p_est1 - p_est2))
-         
-                                df_differences.append([I,M,G,C,lambda_,cv,seed1,seed2,dif_instance])
-                                # else:
-                                #     print("File not found:", file_path)
-                                #     print("File path:", file_path)
-                                #     print("")
-
-df_differences = pd.DataFrame(df_differences, columns=['I','M','G','C','lambda','cv','seed1','seed2','dif_instance'])
+# pairwise differences between initializations (pinit{s} indicates seed {s} for randomized initial matrix p)
+# each 1_pinit{s}.json is read once per configuration; metric can also be 'max' or 'frobenius'
+df_differences = init_sensitivity(results_folder, I_list, B_list, G_list, C_list, lambda_list,
+                                  cv_list, seed_list, method=EM_method_names[0], metric='mae')
 
 
 # pasar a latex la tabla